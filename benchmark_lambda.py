@@ -0,0 +1,1004 @@
+#!/usr/bin/env python3
+"""
+Local benchmark for the Lambda proxy
+在本地 stub Bedrock endpoint 上运行 lambda_proxy，无需 AWS 账户
+"""
+import argparse
+import gc
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+class FakeBedrockHandler(BaseHTTPRequestHandler):
+    """按 REST 路径模拟 bedrock-agent / bedrock-agent-runtime 的响应"""
+
+    protocol_version = 'HTTP/1.1'
+    # 响应头与响应体分两次写出，不关闭 Nagle 会叠加约 40ms 的延迟确认等待
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_throttled(self):
+        body = json.dumps({'message': 'Rate exceeded'}).encode('utf-8')
+        self.send_response(429)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('x-amzn-ErrorType', 'ThrottlingException')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send(self, payload):
+        time.sleep(self.server.latency)
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        request = json.loads(self.rfile.read(length) or b'{}')
+        path = self.path.split('?')[0].rstrip('/')
+
+        match = re.fullmatch(r'/knowledgebases/([^/]+)/retrieve', path)
+        if match:
+            if not self.server.admit():
+                self._send_throttled()
+                return
+            number_of_results = (request.get('retrievalConfiguration', {})
+                                 .get('vectorSearchConfiguration', {})
+                                 .get('numberOfResults', 10))
+            self._send({'retrievalResults': [
+                {
+                    'content': {'text': self.server.chunk_text},
+                    'score': 1.0 - idx / (number_of_results + 1),
+                    'location': {'type': 'S3', 's3Location': {'uri': f's3://bench/{match.group(1)}/{idx}.txt'}},
+                    'metadata': {'x-amz-bedrock-kb-chunk-id': str(idx)}
+                }
+                for idx in range(number_of_results)
+            ]})
+            return
+
+        match = re.fullmatch(r'/knowledgebases/([^/]+)/datasources', path)
+        if match:
+            self._send({'dataSourceSummaries': [
+                {
+                    'dataSourceId': f'DS{idx}',
+                    'knowledgeBaseId': match.group(1),
+                    'name': f'datasource-{idx}',
+                    'status': 'AVAILABLE',
+                    'updatedAt': 0
+                }
+                for idx in range(2)
+            ]})
+            return
+
+        if path == '/knowledgebases':
+            self._send({'knowledgeBaseSummaries': [
+                {
+                    'knowledgeBaseId': f'KB{idx:04d}',
+                    'name': f'knowledge-base-{idx}',
+                    'description': 'benchmark knowledge base',
+                    'status': 'ACTIVE',
+                    'updatedAt': 0
+                }
+                for idx in range(self.server.kb_count)
+            ]})
+            return
+
+        self.send_error(404)
+
+class FakeBedrockServer(ThreadingHTTPServer):
+    """可配置延迟、负载大小和服务端限流（每秒 retrieve 次数）的 fake Bedrock"""
+
+    daemon_threads = True
+
+    def __init__(self, latency: float, chunk_bytes: int, kb_count: int, throttle_rps: float):
+        super().__init__(('127.0.0.1', 0), FakeBedrockHandler)
+        self.latency = latency
+        self.chunk_text = ('lorem ipsum ' * (chunk_bytes // 12 + 1))[:chunk_bytes]
+        self.kb_count = kb_count
+        self.throttle_rps = throttle_rps
+        self.admitted = 0
+        self.throttled = 0
+        self.connections = 0
+        self._tokens = throttle_rps
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        with self._lock:
+            self.connections += 1
+        super().process_request(request, client_address)
+
+    def admit(self) -> bool:
+        """服务端令牌桶，超过 throttle_rps 时返回 False"""
+        with self._lock:
+            if self.throttle_rps <= 0:
+                self.admitted += 1
+                return True
+            now = time.monotonic()
+            self._tokens = min(self.throttle_rps, self._tokens + (now - self._updated_at) * self.throttle_rps)
+            self._updated_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                self.admitted += 1
+                return True
+            self.throttled += 1
+            return False
+
+def start_fake_bedrock(latency: float = 0.0, chunk_bytes: int = 1000, kb_count: int = 5,
+                       throttle_rps: float = 0.0):
+    """在后台线程启动 fake Bedrock server，返回 (server, endpoint_url)"""
+    server = FakeBedrockServer(latency, chunk_bytes, kb_count, throttle_rps)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+def stub_environment(endpoint_url: str) -> dict:
+    """指向本地 stub endpoint 的环境变量"""
+    env = dict(os.environ)
+    env.update({
+        'AWS_ACCESS_KEY_ID': 'bench',
+        'AWS_SECRET_ACCESS_KEY': 'bench',
+        'AWS_REGION': 'us-east-1',
+        'AWS_EC2_METADATA_DISABLED': 'true',
+        'BEDROCK_AGENT_ENDPOINT_URL': endpoint_url,
+        'BEDROCK_AGENT_RUNTIME_ENDPOINT_URL': endpoint_url,
+    })
+    return env
+
+COLD_START_SCRIPT = '''
+import json, sys, time
+sys.path.insert(0, sys.argv[1])
+start = time.perf_counter()
+import lambda_proxy
+imported = time.perf_counter()
+if sys.argv[3:] == ['warm']:
+    assert lambda_proxy.lambda_handler({'warmup': True}, None)['statusCode'] == 200
+warmed = time.perf_counter()
+response = lambda_proxy.lambda_handler(json.loads(sys.argv[2]), None)
+invoked = time.perf_counter()
+assert response['statusCode'] == 200, response
+print(json.dumps({'import_ms': (imported - start) * 1000, 'warmup_ms': (warmed - imported) * 1000,
+                  'first_invoke_ms': (invoked - warmed) * 1000}))
+'''
+
+def bench_cold_start(endpoint_url: str, runs: int, event: dict, warm: bool = False) -> dict:
+    """每次在新进程中测量 import 与首次调用耗时；warm 为 True 时先发送 warmup 事件"""
+    env = stub_environment(endpoint_url)
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', COLD_START_SCRIPT, HERE, json.dumps(event)] + (['warm'] if warm else []),
+            env=env, check=True, capture_output=True, text=True
+        ).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+
+    return {
+        'runs': runs,
+        'import_ms_p50': statistics.median(s['import_ms'] for s in samples),
+        'warmup_ms_p50': statistics.median(s['warmup_ms'] for s in samples),
+        'first_invoke_ms_p50': statistics.median(s['first_invoke_ms'] for s in samples),
+        'total_ms_max': max(s['import_ms'] + s['first_invoke_ms'] for s in samples),
+    }
+
+def load_proxy(endpoint_url: str, **settings):
+    """在当前进程中以 stub 环境导入 lambda_proxy（配置在导入时读取）"""
+    os.environ.update(stub_environment(endpoint_url))
+    os.environ.update({key: str(value) for key, value in settings.items()})
+    sys.path.insert(0, HERE)
+    import lambda_proxy
+    return lambda_proxy
+
+def bench_throttling(proxy, server, requests: int, concurrency: int) -> dict:
+    """并发发送不同的查询，统计服务端限流下的成功率和吞吐"""
+    def invoke(idx):
+        event = {'query': f'throttle test {idx}', 'number_of_results': 3}
+        return proxy.lambda_handler(event, None)['statusCode']
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        status_codes = list(executor.map(invoke, range(requests)))
+    elapsed = time.perf_counter() - start
+
+    succeeded = status_codes.count(200)
+    return {
+        'requests': requests,
+        'succeeded': succeeded,
+        'failed': requests - succeeded,
+        'elapsed_s': elapsed,
+        'throughput_rps': succeeded / elapsed,
+        'server_throttled': server.throttled,
+    }
+
+LOAD_SCENARIOS = {
+    'list': {'tool_name': 'ListKnowledgeBases'},
+    'query': {'tool_name': 'QueryKnowledgeBases', 'query': 'What is Amazon S3?', 'number_of_results': 10},
+    'large-k': {'tool_name': 'QueryKnowledgeBases', 'query': 'What is Amazon S3?', 'number_of_results': 100},
+}
+
+def percentile(sorted_values, fraction: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+def bench_load(proxy, event: dict, requests: int, concurrency: int, memory_samples: int = 10) -> dict:
+    """并发调用 lambda_handler，统计吞吐、延迟分位数和单次调用的内存峰值"""
+    def invoke(_):
+        start = time.perf_counter()
+        response = proxy.lambda_handler(dict(event), None)
+        if response['statusCode'] != 200:
+            raise RuntimeError(response['body'])
+        return time.perf_counter() - start
+
+    proxy.lambda_handler(dict(event), None)  # 预热 client 与连接
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = sorted(executor.map(invoke, range(requests)))
+    elapsed = time.perf_counter() - start
+
+    # tracemalloc 会拖慢执行，单独串行测量内存峰值
+    tracemalloc.start()
+    peak = 0
+    for _ in range(memory_samples):
+        tracemalloc.reset_peak()
+        invoke(None)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+    tracemalloc.stop()
+
+    return {
+        'requests': requests,
+        'throughput_rps': requests / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'peak_kib': peak / 1024,
+    }
+
+def bench_burst(proxy, server, requests: int, concurrency: int, distinct: int) -> dict:
+    """并发发送只有 distinct 种不同查询的突发流量，对比开启/关闭 single-flight 时实际发到后端的检索数"""
+    def invoke(idx):
+        event = {'query': f'hot question {idx % distinct}', 'number_of_results': 5}
+        return proxy.lambda_handler(event, None)['statusCode']
+
+    stats = {}
+    for enabled in (False, True):
+        proxy.SINGLE_FLIGHT_ENABLED = enabled  # 调用时读取，切换无需重新导入
+        admitted, throttled = server.admitted, server.throttled
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            status_codes = list(executor.map(invoke, range(requests)))
+        stats['single-flight' if enabled else 'off'] = {
+            'elapsed_s': time.perf_counter() - start,
+            'succeeded': status_codes.count(200),
+            'backend_calls': server.admitted - admitted,
+            'throttled': server.throttled - throttled,
+        }
+    return stats
+
+def check_warm_handler(proxy, server, event: dict) -> list:
+    """发送 warmup 事件后再发送第一次真实请求，返回发现的重复初始化问题（空列表表示通过）"""
+    response = proxy.lambda_handler({'warmup': True}, None)
+    if response['statusCode'] != 200:
+        return [f"warmup failed: {response['body']}"]
+
+    # 预热建立的连接由 server 线程异步 accept，等计数稳定后再取快照
+    connections = -1
+    while connections != server.connections:
+        connections = server.connections
+        time.sleep(0.05)
+    clients = dict(proxy._clients)
+    admitted = server.admitted
+
+    response = proxy.lambda_handler(event, None)
+    problems = []
+    if response['statusCode'] != 200:
+        problems.append(f"first request failed: {response['body']}")
+    if server.admitted == admitted:
+        problems.append('first request did not reach the backend')
+    if proxy._clients.keys() != clients.keys() or any(proxy._clients[name] is not client
+                                                      for name, client in clients.items()):
+        problems.append('boto3 clients were re-created')
+    if server.connections != connections:
+        problems.append(f"{server.connections - connections} new connection(s) opened")
+    return problems
+
+class FakeThrottlingError(Exception):
+    """与 botocore ClientError 结构相同的限流错误，供 call_bedrock 识别错误码"""
+    response = {'Error': {'Code': 'ThrottlingException'}}
+
+def check_token_bucket(proxy) -> list:
+    """令牌桶：突发容量、按速率补充、等待超时，以及限流后的降速与恢复"""
+    problems = []
+    bucket = proxy.TokenBucket(rate=20, capacity=2, min_rate=5)
+    if not (bucket.acquire(0) and bucket.acquire(0)):
+        problems.append("token bucket rejected requests within its burst capacity")
+    if bucket.acquire(0):
+        problems.append("token bucket granted a token beyond its burst capacity")
+    start = time.monotonic()
+    if not bucket.acquire(0.5):
+        problems.append("token bucket did not refill within the wait timeout")
+    elif not 0.02 <= time.monotonic() - start <= 0.3:
+        problems.append(f"token bucket refill took {time.monotonic() - start:.3f} s at 20 tokens/s")
+
+    bucket.on_throttled()
+    bucket.on_throttled()
+    bucket.on_throttled()
+    if bucket.rate != 5:
+        problems.append(f"throttled rate is {bucket.rate}, expected the 5/s floor")
+    for _ in range(100):
+        bucket.on_success()
+    if bucket.rate != 20:
+        problems.append(f"rate recovered to {bucket.rate}, expected the 20/s ceiling")
+    return problems
+
+def check_circuit_breaker(proxy) -> list:
+    """熔断器：达到阈值后打开，超时后只放行一个探测，探测结果决定关闭或重新打开"""
+    problems = []
+    breaker = proxy.CircuitBreaker(failure_threshold=2, reset_timeout=0.1)
+    breaker.record_failure()
+    if not breaker.allow():
+        problems.append("breaker opened before reaching the failure threshold")
+    breaker.record_failure()
+    if breaker.allow():
+        problems.append("breaker allowed a call right after opening")
+
+    time.sleep(0.15)
+    if not breaker.allow():
+        problems.append("breaker did not allow a probe after the reset timeout")
+    if breaker.allow():
+        problems.append("breaker allowed a second concurrent probe")
+    breaker.record_failure()
+    if breaker.allow():
+        problems.append("breaker did not reopen after a failed probe")
+
+    time.sleep(0.15)
+    breaker.allow()
+    other = threading.Thread(target=breaker.abandon_probe)
+    other.start()
+    other.join()
+    if breaker.allow():
+        problems.append("another thread released the probe it does not own")
+    breaker.abandon_probe()
+    if not breaker.allow():
+        problems.append("breaker did not allow a new probe after the probe was abandoned")
+    breaker.record_success()
+    if not (breaker.allow() and breaker.allow()):
+        problems.append("breaker did not close after a successful probe")
+    return problems
+
+def check_call_bedrock(proxy) -> list:
+    """
+    端到端检查 call_bedrock：半开探测在重试时被客户端限流拒绝后，熔断器仍能恢复
+
+    需要以 CIRCUIT_FAILURE_THRESHOLD=1、RATE_LIMIT_BURST=1、RATE_LIMIT_MAX_WAIT=0 加载代理。
+    """
+    problems = []
+    key = 'RESILIENCE'
+    bucket, breaker = proxy._resilience_for(key)
+
+    def throttled():
+        raise FakeThrottlingError('Rate exceeded')
+
+    breaker.record_failure()
+    time.sleep(proxy.CIRCUIT_RESET_TIMEOUT * 1.5)
+    try:
+        proxy.call_bedrock(key, throttled)
+        problems.append("throttled probe unexpectedly succeeded")
+    except proxy.RateLimitExceeded:
+        pass  # 探测请求在重试时被客户端限流拒绝
+    except Exception as e:
+        problems.append(f"throttled probe raised {type(e).__name__}: {e}")
+
+    # 等待令牌补充（限流后速率已减半）与熔断超时，之后的请求必须能再次探测并关闭熔断器
+    time.sleep(max(2 / bucket.rate, proxy.CIRCUIT_RESET_TIMEOUT) * 1.5)
+    try:
+        if proxy.call_bedrock(key, lambda: 'ok') != 'ok':
+            problems.append("call_bedrock returned an unexpected response")
+    except proxy.CircuitOpenError:
+        problems.append("breaker stayed open after a probe was rejected by the client-side rate limiter")
+    if not breaker.allow():
+        problems.append("breaker did not close after the successful probe")
+    return problems
+
+class StubRuntimeClient:
+    """进程内的 bedrock-agent-runtime 替身：直接返回预先构造的 Retrieve 响应，只测量代理自身的处理开销"""
+
+    def __init__(self, number_of_results: int, chunk_bytes: int):
+        chunk_text = ('lorem ipsum ' * (chunk_bytes // 12 + 1))[:chunk_bytes]
+        self.response = {'retrievalResults': [
+            {
+                'content': {'text': chunk_text},
+                'score': 1.0 - idx / (number_of_results + 1),
+                'location': {'type': 'S3', 's3Location': {'uri': f's3://bench/PIPELINE/{idx}.txt'}},
+                'metadata': {'x-amz-bedrock-kb-chunk-id': str(idx)}
+            }
+            for idx in range(number_of_results)
+        ]}
+
+    def retrieve(self, **kwargs):
+        return self.response
+
+class RecordingRuntimeClient:
+    """记录收到的检索文本，每个查询返回指向自身的结果，便于判断缓存命中的是谁的结果"""
+
+    def __init__(self):
+        self.queries = []
+
+    def retrieve(self, **kwargs):
+        text = kwargs['retrievalQuery']['text']
+        self.queries.append(text)
+        return {'retrievalResults': [{
+            'content': {'text': text}, 'score': 1.0,
+            'location': {'type': 'S3', 's3Location': {'uri': f's3://bench/{len(self.queries)}.txt'}},
+        }]}
+
+def check_semantic_cache(proxy) -> list:
+    """
+    语义缓存：内置哈希向量只复用语序、空白、虚词不同的改写，实体不同的查询必须回源
+
+    需要以 SEMANTIC_CACHE_ENABLED=true 加载代理。
+    """
+    problems = []
+    client = proxy._clients['bedrock-agent-runtime'] = RecordingRuntimeClient()
+    kb_id = 'BENCHKB000'
+
+    def query(text, kb=kb_id):
+        result = proxy.query_knowledge_base(text, kb, 5)
+        return result['results'][0]['content'], result['cache']
+
+    # 只换一个实体时哈希向量的余弦相似度仍高于默认阈值 0.9
+    canada = 'What is the refund policy for orders shipped to Canada for premium members who paid by credit card?'
+    query(canada)
+    for paraphrase in ('what is the refund policy for orders shipped to canada for premium members who paid by credit card',
+                       'What is the refund policy for premium members who paid by credit card for orders shipped to Canada?',
+                       'The refund policy for orders shipped to Canada for premium members who paid by credit card'):
+        content, cache = query(paraphrase)
+        if content != canada:
+            problems.append(f"paraphrase did not reuse the cached result: {paraphrase!r} (cache: {cache})")
+    for other in (canada.replace('Canada', 'Germany'), canada.replace('premium', 'basic'),
+                  canada.replace('refund', 'return'), canada.replace('credit', 'debit')):
+        content, cache = query(other)
+        if content != other:
+            problems.append(f"{other!r} was served the cached result of {content!r}")
+    query(canada, 'BENCHKB001')
+    if len(client.queries) != 6:
+        problems.append(f"expected 6 backend retrievals, got {len(client.queries)}")
+
+    cache = proxy.SemanticCache(dim=8, max_entries=2, ttl=0.05, threshold=0.9)
+    vectors = [[1.0 if idx == slot else 0.0 for idx in range(8)] for slot in range(3)]
+    for slot, vector in enumerate(vectors):
+        cache.add('kb', vector, {'slot': slot})
+    if cache.lookup('kb', vectors[0]) is not None:
+        problems.append("semantic cache kept more entries than max_entries")
+    if cache.lookup('kb', vectors[2]) is None:
+        problems.append("semantic cache lost the most recent entry")
+    if cache.lookup('kb', vectors[2], frozenset({'x'})) is not None:
+        problems.append("semantic cache ignored a term-set mismatch")
+    time.sleep(0.1)
+    if cache.lookup('kb', vectors[2]) is not None:
+        problems.append("semantic cache served an expired entry")
+
+    # 向量维度与缓存不符时跳过语义缓存，查询照常回源
+    embedder = proxy._semantic_embedder
+    proxy.set_semantic_embedder(lambda text: [1.0] * 8)
+    try:
+        retrievals = len(client.queries)
+        query('mismatched embedding dimension')
+        query('mismatched embedding dimension again')
+        if len(client.queries) != retrievals + 2:
+            problems.append("queries with a mismatched embedding dimension did not go to the backend")
+    except Exception as e:
+        problems.append(f"mismatched embedding dimension failed the query: {e}")
+    finally:
+        proxy.set_semantic_embedder(embedder)
+    return problems
+
+def _legacy_retrieve(proxy, query, knowledge_base_id, number_of_results=10, retrieval_filter=None, search_type=None):
+    """改动前的 _retrieve_knowledge_base（不含去重与重排序）：每条检索结果复制为新字典"""
+    vector_search_config = {'numberOfResults': number_of_results}
+    if retrieval_filter:
+        vector_search_config['filter'] = retrieval_filter
+    if search_type:
+        vector_search_config['overrideSearchType'] = search_type
+    with proxy.span('retrieve'):
+        response, _ = proxy.hedged_call(lambda: proxy.call_bedrock(
+            knowledge_base_id, proxy.get_client('bedrock-agent-runtime').retrieve,
+            knowledgeBaseId=knowledge_base_id, retrievalQuery={'text': query},
+            retrievalConfiguration={'vectorSearchConfiguration': vector_search_config}
+        ))
+    results = []
+    for item in response.get('retrievalResults', []):
+        results.append({
+            'content': item['content']['text'],
+            'score': item.get('score', 0),
+            'location': item.get('location', {}),
+            'metadata': item.get('metadata', {})
+        })
+    results = results[:number_of_results]
+    return {'query': query, 'knowledge_base_id': knowledge_base_id, 'results': results, 'count': len(results)}
+
+def _legacy_markdown(result: dict):
+    """改动前的 iter_query_results（不限预算）：逐条从结果字典取字段格式化"""
+    parts = [
+        "# 知识库查询结果\n\n",
+        f"**查询**: {result.get('query', '')}\n",
+        f"**知识库ID**: {result.get('knowledge_base_id', '')}\n",
+        f"**结果数量**: {result.get('count', 0)}\n\n"
+    ]
+    results = result.get('results', [])
+    if not results:
+        parts.append("未找到相关结果。\n")
+        yield ''.join(parts)
+        return
+    yield ''.join(parts)
+
+    for idx, item in enumerate(results, 1):
+        content = item.get('content', '无内容')
+        score = item.get('score', 0)
+        location = item.get('location', {})
+        header = f"## 结果 {idx} (相关度: {score:.4f})\n\n"
+        footer = ""
+        if location:
+            s3_location = location.get('s3Location', {})
+            if s3_location:
+                footer += f"**来源**: {s3_location.get('uri', '未知')}\n\n"
+        footer += "---\n\n"
+        yield f"{header}{content}\n\n{footer}"
+
+def _legacy_structured(result: dict, output_format: str):
+    """改动前的 project_query_result + iter_structured：每条结果再复制一次，逐次调用带参数的 json.dumps"""
+    items = []
+    for item in result['results']:
+        if output_format == 'compact':
+            projected = {'content': item.get('content', ''), 'score': item.get('score', 0)}
+            uri = item.get('location', {}).get('s3Location', {}).get('uri')
+            if uri:
+                projected['source'] = uri
+        else:
+            projected = dict(item)
+        items.append(projected)
+    data = {'query': result['query'], 'knowledge_base_id': result['knowledge_base_id'],
+            'results': items, 'count': len(items)}
+
+    if output_format == 'compact':
+        item_separator, key_separator = ',', ':'
+    else:
+        item_separator, key_separator = ', ', ': '
+
+    def dumps(value):
+        return json.dumps(value, ensure_ascii=False, separators=(item_separator, key_separator), default=str)
+
+    yield '{'
+    for idx, (key, value) in enumerate(data.items()):
+        prefix = (item_separator if idx else '') + dumps(key) + key_separator
+        if isinstance(value, list) and value:
+            yield prefix + '[' + dumps(value[0])
+            for element in value[1:]:
+                yield item_separator + dumps(element)
+            yield ']'
+        else:
+            yield prefix + dumps(value)
+    yield '}'
+
+def _legacy_dispatch(proxy, event: dict, metrics) -> tuple:
+    """改动前的 QueryKnowledgeBases 分发：查询沿用 run_query（检索已替换为 _legacy_retrieve），按字典格式化"""
+    metrics.tool = 'QueryKnowledgeBases'
+    output_format, _ = proxy._output_options(event)
+    result = proxy.run_query(event)
+    if output_format == 'markdown':
+        return result, lambda: _legacy_markdown(result)
+    return result, lambda: _legacy_structured(result, output_format)
+
+def _legacy_serialize_body(chunks, meta=None) -> str:
+    """改动前的序列化：先拼出完整的格式化文本，再构造 body 字典整体 json.dumps"""
+    body = {'content': [{'type': 'text', 'text': ''.join(chunks)}]}
+    if meta:
+        body['_meta'] = meta
+    return json.dumps(body)
+
+def invoke_pipeline(proxy, event: dict, legacy: bool = False, on_serialized=None) -> str:
+    """
+    调用 lambda_handler 并返回响应体
+
+    legacy=True 时换用改动前的检索结果表示、格式化与序列化（只覆盖单知识库、不限预算的查询），
+    参数校验、缓存、请求合并等其余开销与当前实现相同。
+    on_serialized 在响应体生成后、本次调用的中间数据释放前调用。
+    """
+    dispatch, retrieve, serialize_body = proxy._dispatch, proxy._retrieve_knowledge_base, proxy.serialize_body
+    if legacy:
+        proxy._dispatch = lambda event, metrics: _legacy_dispatch(proxy, event, metrics)
+        proxy._retrieve_knowledge_base = lambda *args: _legacy_retrieve(proxy, *args)
+        proxy.serialize_body = _legacy_serialize_body
+    if on_serialized is not None:
+        serialize = proxy.serialize_body
+
+        def traced_serialize_body(*args):
+            body_json = serialize(*args)
+            on_serialized()
+            return body_json
+        proxy.serialize_body = traced_serialize_body
+    try:
+        response = proxy.lambda_handler(dict(event), None)
+    finally:
+        proxy._dispatch, proxy._retrieve_knowledge_base, proxy.serialize_body = dispatch, retrieve, serialize_body
+    if response['statusCode'] != 200:
+        raise RuntimeError(response['body'])
+    return response['body']
+
+def bench_pipeline(proxy, number_of_results: int, chunk_bytes: int, runs: int) -> tuple:
+    """
+    逐个输出格式测量单次调用的 CPU 时间中位数、存活分配块数与内存峰值（不经过网络），返回 (统计, 问题列表)
+
+    legacy 为进程内重现的改动前流水线（逐条复制字典、整体 json.dumps）；json / orjson 为当前实现在两种
+    JSON 后端下的表现。各模式交替计时，减少机器抖动对对比的影响。allocs 为响应体生成完成时、本次调用分配
+    且仍存活的内存块数（tracemalloc 快照差值），反映同时持有的中间副本。
+    当前实现在 json 后端下必须与 legacy 输出完全一致，分配块数与内存峰值更低，
+    CPU 时间不得超出 legacy 的 cpu_tolerance 倍（计时抖动较大，只拦截明显的回退）。
+    """
+    cpu_tolerance = 1.2
+    proxy._clients['bedrock-agent-runtime'] = StubRuntimeClient(number_of_results, chunk_bytes)
+    modes = [('legacy', 'json'), ('json', 'json')]
+    if getattr(proxy, 'orjson', None) is not None:
+        modes.append(('orjson', 'orjson'))
+
+    stats, problems = {}, []
+    for output_format in ('markdown', 'json', 'compact'):
+        event = {'query': 'What is Amazon S3?', 'number_of_results': number_of_results,
+                 'output_format': output_format}
+
+        def invoke(mode, backend, on_serialized=None):
+            proxy.JSON_BACKEND = backend
+            return invoke_pipeline(proxy, event, mode == 'legacy', on_serialized)
+
+        bodies = {mode: invoke(mode, backend) for mode, backend in modes}
+
+        # 交替调用各模式后取中位数
+        timings = {mode: [] for mode, _ in modes}
+        for _ in range(runs):
+            for mode, backend in modes:
+                cpu_start = time.process_time()
+                invoke(mode, backend)
+                timings[mode].append(time.process_time() - cpu_start)
+
+        for mode, backend in modes:
+            # 完整回收会清空 dict 等对象的 freelist，使调用中创建的对象都经过分配器、被 tracemalloc 记录
+            gc.collect()
+            snapshots = []
+            tracemalloc.start()
+            snapshots.append(tracemalloc.take_snapshot())
+            invoke(mode, backend, lambda: snapshots.append(tracemalloc.take_snapshot()))
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            stats[(mode, output_format)] = {
+                'cpu_us': percentile(sorted(timings[mode]), 0.50) * 1e6,
+                'allocs': sum(stat.count_diff for stat in snapshots[1].compare_to(snapshots[0], 'filename')),
+                'peak_kib': peak / 1024,
+                'body_kib': len(bodies[mode]) / 1024,
+            }
+
+        if bodies['json'] != bodies['legacy']:
+            problems.append(f"{output_format}: response body differs from the legacy pipeline")
+        legacy = stats[('legacy', output_format)]
+        for mode, _ in modes[1:]:
+            row = stats[(mode, output_format)]
+            if row['allocs'] >= legacy['allocs']:
+                problems.append(f"{output_format}: {mode} holds {row['allocs']} blocks, "
+                                f"not fewer than the legacy {legacy['allocs']}")
+            if row['peak_kib'] >= legacy['peak_kib']:
+                problems.append(f"{output_format}: {mode} peak {row['peak_kib']:.1f} KiB "
+                                f"is not below the legacy peak {legacy['peak_kib']:.1f} KiB")
+            if row['cpu_us'] > legacy['cpu_us'] * cpu_tolerance:
+                problems.append(f"{output_format}: {mode} CPU {row['cpu_us']:.0f} us is more than "
+                                f"{cpu_tolerance - 1:.0%} above the legacy {legacy['cpu_us']:.0f} us")
+    return stats, problems
+
+def engine_scenarios(kb_count: int) -> dict:
+    kb_ids = [f'BENCHKB{idx:03d}' for idx in range(kb_count)]  # Retrieve 要求知识库ID为 10 个字符
+    return {
+        'list': {'tool_name': 'ListKnowledgeBases'},
+        'multi-kb': {'tool_name': 'QueryKnowledgeBases', 'query': 'What is Amazon S3?', 'knowledge_base_ids': kb_ids},
+        'batch': {
+            'tool_name': 'BatchQueryKnowledgeBases',
+            'queries': [f'question {idx}' for idx in range(8)],
+            'knowledge_base_ids': kb_ids[:3],
+        },
+    }
+
+def bench_engines(proxy, event: dict, runs: int) -> dict:
+    """在主线程串行调用 lambda_handler（与 Lambda 一致），对比 threads 与 asyncio 引擎的延迟"""
+    stats = {}
+    for engine in ('threads', 'asyncio'):
+        proxy.IO_ENGINE = engine  # 引擎在调用时读取，切换无需重新导入
+        proxy.lambda_handler(dict(event), None)  # 预热 client、连接与事件循环
+        latencies = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            response = proxy.lambda_handler(dict(event), None)
+            if response['statusCode'] != 200:
+                raise RuntimeError(response['body'])
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        stats[engine] = {
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+        }
+    return stats
+
+def bench_stream(proxy, event: dict, runs: int) -> dict:
+    """对比 lambda_handler 与 stream_handler 的首字节时间、总耗时和内存峰值"""
+    def buffered():
+        start = time.perf_counter()
+        body = proxy.lambda_handler(dict(event), None)['body']
+        elapsed = time.perf_counter() - start
+        return elapsed, elapsed, len(body.encode('utf-8'))
+
+    def streamed():
+        start = time.perf_counter()
+        first_byte = None
+        size = 0
+        for chunk in proxy.stream_handler(dict(event), None):
+            if first_byte is None:
+                first_byte = time.perf_counter() - start
+            size += len(chunk)  # 模拟边产出边发送，不保留已发送的分块
+        return first_byte, time.perf_counter() - start, size
+
+    stats = {}
+    for name, invoke in (('buffered', buffered), ('stream', streamed)):
+        invoke()  # 预热 client 与连接
+        timings = [invoke() for _ in range(runs)]
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        size = invoke()[2]
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        stats[name] = {
+            'first_byte_ms': statistics.median(t[0] for t in timings) * 1000,
+            'total_ms': statistics.median(t[1] for t in timings) * 1000,
+            'body_kib': size / 1024,
+            'peak_kib': peak / 1024,
+        }
+    return stats
+
+def check_stream_memory(proxy, chunk_bytes: int = 4000, small_k: int = 25, large_k: int = 100) -> tuple:
+    """
+    用进程内 Retrieve 替身测量 stream_handler 在两个 k 下的内存峰值，返回 (各格式统计, 问题列表)
+
+    替身的响应在测量前已经构造好，峰值只包含代理自身的格式化与序列化。流式峰值的上限是固定大小的
+    分块缓冲区加上每条结果很小的簿记开销，因此两个 k 下的响应体都要远大于 STREAM_CHUNK_BYTES；
+    峰值增长超过响应体增长的 25% 说明流式路径仍在整体缓冲（整体缓冲时约为 2 倍）。
+    """
+    previous = proxy._clients.get('bedrock-agent-runtime')
+    stats, problems = {}, []
+    try:
+        for output_format in ('markdown', 'json', 'compact'):
+            for k in (small_k, large_k):
+                proxy._clients['bedrock-agent-runtime'] = StubRuntimeClient(k, chunk_bytes)
+                event = {'query': 'What is Amazon S3?', 'number_of_results': k, 'output_format': output_format}
+                sum(len(chunk) for chunk in proxy.stream_handler(dict(event), None))
+                tracemalloc.start()
+                size = sum(len(chunk) for chunk in proxy.stream_handler(dict(event), None))
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                stats[(output_format, k)] = {'body_kib': size / 1024, 'peak_kib': peak / 1024}
+            small, large = stats[(output_format, small_k)], stats[(output_format, large_k)]
+            growth = large['peak_kib'] - small['peak_kib']
+            body_growth = large['body_kib'] - small['body_kib']
+            if growth > 0.25 * body_growth:
+                problems.append(f"{output_format}: streamed peak grew {growth:.1f} KiB from k={small_k} to k={large_k} "
+                                f"(body grew {body_growth:.1f} KiB)")
+    finally:
+        if previous is None:
+            proxy._clients.pop('bedrock-agent-runtime', None)
+        else:
+            proxy._clients['bedrock-agent-runtime'] = previous
+    return stats, problems
+
+def run_cold_start(args):
+    server, endpoint_url = start_fake_bedrock(latency=args.latency_ms / 1000)
+    try:
+        print("=== Cold start ===")
+        for name, event in (('list', {}), ('query', {'query': 'What is S3?', 'number_of_results': 5})):
+            stats = bench_cold_start(endpoint_url, args.runs, event)
+            print(f"{name:>6}: import p50 {stats['import_ms_p50']:.1f} ms, "
+                  f"first invoke p50 {stats['first_invoke_ms_p50']:.1f} ms, "
+                  f"max total {stats['total_ms_max']:.1f} ms")
+
+            cold_start_ms = stats['import_ms_p50'] + stats['first_invoke_ms_p50']
+            if args.max_cold_start_ms and cold_start_ms > args.max_cold_start_ms:
+                print(f"✗ {name} cold start {cold_start_ms:.1f} ms exceeds {args.max_cold_start_ms:.1f} ms")
+                sys.exit(1)
+    finally:
+        server.shutdown()
+
+def run_warmup(args):
+    server, endpoint_url = start_fake_bedrock(latency=args.latency_ms / 1000)
+    try:
+        event = {'query': 'What is S3?', 'number_of_results': 5}
+        print("=== Warmup ===")
+        for name, warm in (('cold', False), ('warmed', True)):
+            stats = bench_cold_start(endpoint_url, args.runs, event, warm)
+            print(f"{name:>7}: import p50 {stats['import_ms_p50']:.1f} ms, "
+                  f"warmup p50 {stats['warmup_ms_p50']:.1f} ms, "
+                  f"first invoke p50 {stats['first_invoke_ms_p50']:.1f} ms")
+
+        proxy = load_proxy(endpoint_url, LOG_LEVEL='ERROR', METRICS_ENABLED='false')
+        problems = check_warm_handler(proxy, server, event)
+        for problem in problems:
+            print(f"✗ {problem}")
+        if problems:
+            sys.exit(1)
+        print("✓ Warmed handler served its first request without creating clients or connections")
+    finally:
+        server.shutdown()
+
+def run_throttle(args):
+    server, endpoint_url = start_fake_bedrock(latency=args.latency_ms / 1000, throttle_rps=args.throttle_rps)
+    try:
+        proxy = load_proxy(endpoint_url, QUERY_CACHE_TTL=0, LOG_LEVEL='CRITICAL', METRICS_ENABLED='false',
+                           RATE_LIMIT_PER_KB=args.client_rps, RATE_LIMIT_BURST=args.client_rps)
+        stats = bench_throttling(proxy, server, args.requests, args.concurrency)
+        print("=== Throttling ===")
+        print(f"succeeded {stats['succeeded']}/{stats['requests']} in {stats['elapsed_s']:.2f} s "
+              f"({stats['throughput_rps']:.1f} req/s), server throttled {stats['server_throttled']} calls")
+        if stats['failed']:
+            sys.exit(1)
+    finally:
+        server.shutdown()
+
+def run_load(args):
+    server, endpoint_url = start_fake_bedrock(
+        latency=args.latency_ms / 1000, chunk_bytes=args.chunk_bytes, kb_count=args.kb_count
+    )
+    try:
+        settings = {'LOG_LEVEL': 'ERROR', 'METRICS_ENABLED': 'false', 'RATE_LIMIT_PER_KB': 0}
+        if not args.with_cache:
+            settings.update({'QUERY_CACHE_TTL': 0, 'KB_LIST_CACHE_TTL': 0, 'KB_LIST_CACHE_STALE_TTL': 0})
+        proxy = load_proxy(endpoint_url, **settings)
+
+        print(f"=== Load ({args.requests} requests, concurrency {args.concurrency}, "
+              f"latency {args.latency_ms:.0f} ms, chunk {args.chunk_bytes} B, {args.kb_count} KBs) ===")
+        print(f"{'scenario':>8} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'peak KiB':>10}")
+        for name in args.load_scenarios:
+            stats = bench_load(proxy, LOAD_SCENARIOS[name], args.requests, args.concurrency)
+            print(f"{name:>8} {stats['throughput_rps']:>9.1f} {stats['p50_ms']:>9.2f} "
+                  f"{stats['p95_ms']:>9.2f} {stats['p99_ms']:>9.2f} {stats['peak_kib']:>10.1f}")
+    finally:
+        server.shutdown()
+
+def run_stream(args):
+    server, endpoint_url = start_fake_bedrock(latency=args.latency_ms / 1000, chunk_bytes=args.chunk_bytes)
+    try:
+        proxy = load_proxy(endpoint_url, LOG_LEVEL='ERROR', METRICS_ENABLED='false', RATE_LIMIT_PER_KB=0,
+                           QUERY_CACHE_TTL=0)
+        print(f"=== Streaming (k=100, chunk {args.chunk_bytes} B, {args.runs} runs) ===")
+        print(f"{'format':>8} {'mode':>9} {'first byte ms':>14} {'total ms':>9} {'body KiB':>9} {'peak KiB':>9}")
+        for output_format in ('markdown', 'json'):
+            event = dict(LOAD_SCENARIOS['large-k'], output_format=output_format)
+            for mode, stats in bench_stream(proxy, event, args.runs).items():
+                print(f"{output_format:>8} {mode:>9} {stats['first_byte_ms']:>14.2f} {stats['total_ms']:>9.2f} "
+                      f"{stats['body_kib']:>9.1f} {stats['peak_kib']:>9.1f}")
+
+        print("=== Streamed peak vs k (in-process Retrieve stub, chunk 4000 B) ===")
+        print(f"{'format':>8} {'k':>4} {'body KiB':>9} {'peak KiB':>9}")
+        memory, problems = check_stream_memory(proxy)
+        for (output_format, k), stats in memory.items():
+            print(f"{output_format:>8} {k:>4} {stats['body_kib']:>9.1f} {stats['peak_kib']:>9.1f}")
+    finally:
+        server.shutdown()
+    for problem in problems:
+        print(f"✗ {problem}")
+    if problems:
+        sys.exit(1)
+    print("✓ Streamed peak memory does not grow with the number of results")
+
+def run_pipeline(args):
+    # 不需要 fake server：Retrieve 响应由进程内替身直接返回
+    proxy = load_proxy('http://127.0.0.1:9', QUERY_CACHE_TTL=0, RATE_LIMIT_PER_KB=0,
+                       LOG_LEVEL='ERROR', METRICS_ENABLED='false')
+    print(f"=== Result pipeline (k=100, chunk {args.chunk_bytes} B, {args.runs} runs) ===")
+    print(f"{'mode':>8} {'format':>9} {'p50 cpu us':>11} {'allocs':>7} {'peak KiB':>9} {'body KiB':>9}")
+    stats, problems = bench_pipeline(proxy, 100, args.chunk_bytes, args.runs)
+    for (mode, output_format), row in stats.items():
+        print(f"{mode:>8} {output_format:>9} {row['cpu_us']:>11.0f} {row['allocs']:>7} "
+              f"{row['peak_kib']:>9.1f} {row['body_kib']:>9.1f}")
+    for problem in problems:
+        print(f"✗ {problem}")
+    if problems:
+        sys.exit(1)
+    print("✓ Single-pass serializer matches the legacy output with fewer live allocations, a lower peak and no CPU regression")
+
+def run_resilience(args):
+    proxy = load_proxy('http://127.0.0.1:9', LOG_LEVEL='CRITICAL', METRICS_ENABLED='false',
+                       CIRCUIT_FAILURE_THRESHOLD=1, CIRCUIT_RESET_TIMEOUT=0.2, RATE_LIMIT_PER_KB=5,
+                       RATE_LIMIT_BURST=1, RATE_LIMIT_MAX_WAIT=0, RETRY_BASE_DELAY=0)
+    print("=== Resilience ===")
+    problems = check_token_bucket(proxy) + check_circuit_breaker(proxy) + check_call_bedrock(proxy)
+    for problem in problems:
+        print(f"✗ {problem}")
+    if problems:
+        sys.exit(1)
+    print("✓ Token bucket, circuit breaker and half-open probing behave as expected")
+
+def run_semantic_cache(args):
+    proxy = load_proxy('http://127.0.0.1:9', LOG_LEVEL='CRITICAL', METRICS_ENABLED='false',
+                       SEMANTIC_CACHE_ENABLED='true', RATE_LIMIT_PER_KB=0)
+    print("=== Semantic cache ===")
+    problems = check_semantic_cache(proxy)
+    for problem in problems:
+        print(f"✗ {problem}")
+    if problems:
+        sys.exit(1)
+    print("✓ Paraphrases hit the semantic cache and queries about other entities go to the backend")
+
+def run_burst(args):
+    server, endpoint_url = start_fake_bedrock(latency=args.latency_ms / 1000, throttle_rps=args.throttle_rps)
+    try:
+        # 关闭结果缓存，只观察在途请求合并的效果
+        proxy = load_proxy(endpoint_url, QUERY_CACHE_TTL=0, LOG_LEVEL='CRITICAL', METRICS_ENABLED='false',
+                           RATE_LIMIT_PER_KB=0)
+        print(f"=== Burst ({args.requests} requests, {args.distinct_queries} distinct, "
+              f"concurrency {args.concurrency}, latency {args.latency_ms:.0f} ms) ===")
+        print(f"{'mode':>13} {'succeeded':>10} {'backend':>8} {'throttled':>10} {'elapsed s':>10}")
+        for mode, stats in bench_burst(proxy, server, args.requests, args.concurrency, args.distinct_queries).items():
+            print(f"{mode:>13} {stats['succeeded']:>10} {stats['backend_calls']:>8} "
+                  f"{stats['throttled']:>10} {stats['elapsed_s']:>10.2f}")
+    finally:
+        server.shutdown()
+
+def run_engines(args):
+    server, endpoint_url = start_fake_bedrock(
+        latency=args.latency_ms / 1000, chunk_bytes=args.chunk_bytes, kb_count=args.kb_count
+    )
+    try:
+        proxy = load_proxy(endpoint_url, LOG_LEVEL='ERROR', METRICS_ENABLED='false', RATE_LIMIT_PER_KB=0,
+                           QUERY_CACHE_TTL=0, KB_LIST_CACHE_TTL=0, KB_LIST_CACHE_STALE_TTL=0)
+        print(f"=== I/O engines ({args.runs} runs, latency {args.latency_ms:.0f} ms, {args.kb_count} KBs) ===")
+        print(f"{'scenario':>8} {'engine':>8} {'p50 ms':>9} {'p95 ms':>9}")
+        for name, event in engine_scenarios(args.kb_count).items():
+            for engine, stats in bench_engines(proxy, event, args.runs).items():
+                print(f"{name:>8} {engine:>8} {stats['p50_ms']:>9.2f} {stats['p95_ms']:>9.2f}")
+    finally:
+        server.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark lambda_proxy against a local fake Bedrock backend')
+    parser.add_argument('--scenario', default='load', choices=[
+        'cold-start', 'warmup', 'throttle', 'load', 'stream', 'engines', 'burst', 'pipeline', 'resilience',
+        'semantic-cache'
+    ])
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='simulated backend latency')
+    parser.add_argument('--runs', type=int, default=5, help='number of cold-start / warmup / stream / engines / pipeline runs')
+    parser.add_argument('--max-cold-start-ms', type=float, default=0.0,
+                        help='fail if p50 import + first invocation exceeds this (0 = no check)')
+    parser.add_argument('--requests', type=int, default=200, help='requests per load/throttle/burst scenario')
+    parser.add_argument('--concurrency', type=int, default=16, help='client threads')
+    parser.add_argument('--throttle-rps', type=float, default=50.0, help='server-side retrieve limit')
+    parser.add_argument('--client-rps', type=float, default=50.0, help='RATE_LIMIT_PER_KB for the proxy')
+    parser.add_argument('--chunk-bytes', type=int, default=1000, help='size of each retrieved chunk')
+    parser.add_argument('--kb-count', type=int, default=5, help='knowledge bases returned by the fake backend')
+    parser.add_argument('--load-scenarios', nargs='+', choices=list(LOAD_SCENARIOS), default=list(LOAD_SCENARIOS))
+    parser.add_argument('--with-cache', action='store_true', help='keep the proxy caches enabled')
+    parser.add_argument('--distinct-queries', type=int, default=4, help='distinct queries in the burst scenario')
+    args = parser.parse_args()
+
+    {
+        'cold-start': run_cold_start, 'warmup': run_warmup, 'throttle': run_throttle, 'load': run_load, 'stream': run_stream,
+        'engines': run_engines, 'burst': run_burst, 'pipeline': run_pipeline, 'resilience': run_resilience,
+        'semantic-cache': run_semantic_cache,
+    }[args.scenario](args)
+
+if __name__ == "__main__":
+    main()
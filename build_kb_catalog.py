@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""
+Build the Knowledge Base catalog snapshot bundled with the Lambda
+Reads configuration from environment variables
+"""
+import os
+import sys
+
+def load_config():
+    """Load configuration from environment variables"""
+    region = os.environ.get('AWS_REGION', 'us-east-1')
+    output = os.environ.get('KB_CATALOG_OUTPUT', 'kb_catalog.json')
+    return region, output
+
+def main():
+    print("=== Build KB Catalog ===\n")
+
+    region, output = load_config()
+    os.environ.setdefault('BEDROCK_REGION', region)
+
+    # lambda_proxy 在导入时读取配置，需在设置环境变量之后导入
+    import lambda_proxy
+
+    print(f"Region: {region}")
+    print(f"Output: {output}")
+
+    previous = lambda_proxy.load_kb_catalog(output)
+    try:
+        catalog, diff = lambda_proxy.build_kb_catalog(previous)
+    except Exception as e:
+        print(f"✗ Failed to build KB catalog: {e}")
+        sys.exit(1)
+
+    lambda_proxy.save_kb_catalog(catalog, output)
+    tagged = catalog.tagged(lambda_proxy.KB_TAG_KEY, lambda_proxy.KB_TAG_VALUE)
+    print(f"✓ KB catalog written: {len(catalog.knowledge_bases)} knowledge bases, "
+          f"{len(tagged)} tagged {lambda_proxy.KB_TAG_KEY}={lambda_proxy.KB_TAG_VALUE}")
+    if previous is not None:
+        print(f"  Added: {len(diff['added'])}, updated: {len(diff['updated'])}, removed: {len(diff['removed'])}")
+
+if __name__ == "__main__":
+    main()
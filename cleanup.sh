@@ -26,7 +26,9 @@ fi
 
 # 加载环境变量
 echo -e "${BLUE}[1/6]${NC} 加载配置..."
-export $(cat .env | grep -v '^#' | grep -v '^$' | xargs)
+set -a
+. ./.env
+set +a
 
 if [ -z "$AWS_REGION" ]; then
     AWS_REGION="us-east-1"
@@ -39,7 +41,7 @@ echo ""
 # 确认删除
 echo -e "${YELLOW}⚠️  警告: 即将删除以下资源:${NC}"
 echo ""
-[ -n "$LAMBDA_ARN" ] && echo "  - Lambda 函数: $(basename $LAMBDA_ARN)"
+[ -n "$LAMBDA_ARN" ] && echo "  - Lambda 函数: $(echo $LAMBDA_ARN | cut -d: -f7)"
 [ -n "$GATEWAY_ID" ] && echo "  - Gateway: $GATEWAY_ID"
 [ -n "$COGNITO_USER_POOL_ID" ] && echo "  - Cognito User Pool: $COGNITO_USER_POOL_ID"
 echo "  - IAM 角色和策略"
@@ -141,10 +143,17 @@ else
 fi
 echo ""
 
-# 4. 删除 Lambda 函数
+# 4. 删除 Lambda 函数（LAMBDA_ARN 可能带别名，取第 7 段作为函数名）
 if [ -n "$LAMBDA_ARN" ]; then
     echo -e "${BLUE}[5/6]${NC} 删除 Lambda 函数..."
-    LAMBDA_NAME=$(basename $LAMBDA_ARN)
+    LAMBDA_NAME=$(echo $LAMBDA_ARN | cut -d: -f7)
+    
+    # 删除定时预热规则（如果有）
+    aws events remove-targets --rule ${LAMBDA_NAME}-warmer --ids warmer \
+        --region $AWS_REGION >/dev/null 2>&1 || true
+    aws events delete-rule --name ${LAMBDA_NAME}-warmer \
+        --region $AWS_REGION 2>/dev/null || true
+    
     aws lambda delete-function \
         --function-name $LAMBDA_NAME \
         --region $AWS_REGION 2>/dev/null && \
@@ -160,7 +169,7 @@ echo -e "${BLUE}[6/6]${NC} 删除 IAM 角色..."
 
 # 删除 Lambda IAM 角色
 if [ -n "$LAMBDA_ARN" ]; then
-    LAMBDA_NAME=$(basename $LAMBDA_ARN)
+    LAMBDA_NAME=$(echo $LAMBDA_ARN | cut -d: -f7)
     LAMBDA_ROLE_NAME=$(echo $LAMBDA_NAME | sed 's/Proxy/LambdaRole/g')
     
     echo "  删除 Lambda IAM 角色: $LAMBDA_ROLE_NAME"
@@ -180,6 +189,7 @@ echo ""
 # 6. 清理本地文件
 echo -e "${BLUE}清理本地文件...${NC}"
 rm -f lambda_proxy.zip
+rm -f kb_catalog.json
 rm -f .env.bak
 echo -e "${GREEN}✓${NC} 本地文件清理完成"
 echo ""
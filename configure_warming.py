@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Configure provisioned concurrency and a scheduled warmer for the Lambda proxy
+Reads configuration from environment variables
+"""
+import boto3
+import json
+import sys
+import os
+
+WARMUP_EVENT = {"warmup": True}
+WARMER_TARGET_ID = "warmer"
+WARMER_STATEMENT_ID = "scheduled-warmer"
+
+def load_config():
+    """Load configuration from environment variables"""
+    function_name = os.environ.get('LAMBDA_FUNCTION_NAME')
+    region = os.environ.get('AWS_REGION', 'us-east-1')
+    provisioned_concurrency = int(os.environ.get('PROVISIONED_CONCURRENCY') or 0)
+    alias = os.environ.get('LAMBDA_ALIAS') or 'live'
+    schedule = os.environ.get('WARMER_SCHEDULE', '')
+    gateway_id = os.environ.get('GATEWAY_ID', '')
+
+    if not function_name:
+        print("Error: LAMBDA_FUNCTION_NAME environment variable is required")
+        sys.exit(1)
+
+    return function_name, region, provisioned_concurrency, alias, schedule, gateway_id
+
+def alias_exists(client, function_name: str, alias: str) -> bool:
+    """Check whether the alias has been created by a previous deployment"""
+    try:
+        client.get_alias(FunctionName=function_name, Name=alias)
+        return True
+    except client.exceptions.ResourceNotFoundException:
+        return False
+
+def publish_alias(client, function_name: str, alias: str) -> str:
+    """Publish the current code as a new version and point the alias at it"""
+    client.get_waiter('function_active').wait(FunctionName=function_name)
+    client.get_waiter('function_updated').wait(FunctionName=function_name)
+    version = client.publish_version(FunctionName=function_name)['Version']
+    try:
+        response = client.update_alias(FunctionName=function_name, Name=alias, FunctionVersion=version)
+    except client.exceptions.ResourceNotFoundException:
+        response = client.create_alias(FunctionName=function_name, Name=alias, FunctionVersion=version)
+    print(f"✓ Alias {alias} -> version {version}")
+    return response['AliasArn']
+
+def configure_provisioned_concurrency(client, function_name: str, alias: str, count: int):
+    """Set (or remove, when count is 0) provisioned concurrency on the alias"""
+    if count > 0:
+        client.put_provisioned_concurrency_config(
+            FunctionName=function_name,
+            Qualifier=alias,
+            ProvisionedConcurrentExecutions=count
+        )
+        print(f"✓ Provisioned concurrency on {alias}: {count} (allocation takes a few minutes)")
+        return
+
+    try:
+        client.delete_provisioned_concurrency_config(FunctionName=function_name, Qualifier=alias)
+        print(f"✓ Provisioned concurrency removed from {alias}")
+    except (client.exceptions.ProvisionedConcurrencyConfigNotFoundException,
+            client.exceptions.ResourceNotFoundException):
+        pass
+
+def configure_warmer(region: str, function_name: str, function_arn: str, schedule: str):
+    """Create, update or remove the EventBridge rule that sends warmup events"""
+    events = boto3.client('events', region_name=region)
+    lambda_client = boto3.client('lambda', region_name=region)
+    rule_name = f"{function_name}-warmer"
+
+    if not schedule:
+        try:
+            events.remove_targets(Rule=rule_name, Ids=[WARMER_TARGET_ID])
+            events.delete_rule(Name=rule_name)
+            print(f"✓ Scheduled warmer {rule_name} removed")
+        except events.exceptions.ResourceNotFoundException:
+            pass
+        return
+
+    rule_arn = events.put_rule(
+        Name=rule_name,
+        ScheduleExpression=schedule,
+        State='ENABLED',
+        Description='Sends warmup events to the Bedrock KB MCP proxy'
+    )['RuleArn']
+
+    try:
+        lambda_client.add_permission(
+            FunctionName=function_arn,
+            StatementId=WARMER_STATEMENT_ID,
+            Action='lambda:InvokeFunction',
+            Principal='events.amazonaws.com',
+            SourceArn=rule_arn
+        )
+    except lambda_client.exceptions.ResourceConflictException:
+        pass  # permission already granted by a previous deployment
+
+    events.put_targets(
+        Rule=rule_name,
+        Targets=[{'Id': WARMER_TARGET_ID, 'Arn': function_arn, 'Input': json.dumps(WARMUP_EVENT)}]
+    )
+    print(f"✓ Scheduled warmer {rule_name}: {schedule}")
+
+def point_gateway_targets(region: str, gateway_id: str, function_arn: str):
+    """Point the Gateway targets that invoke this function (any version or alias) at function_arn"""
+    client = boto3.client('bedrock-agentcore-control', region_name=region)
+    unqualified_arn = ':'.join(function_arn.split(':')[:7])
+    kwargs = {'gatewayIdentifier': gateway_id}
+    while True:
+        response = client.list_gateway_targets(**kwargs)
+        for item in response.get('items', []):
+            target = client.get_gateway_target(gatewayIdentifier=gateway_id, targetId=item['targetId'])
+            lambda_config = target['targetConfiguration'].get('mcp', {}).get('lambda')
+            if not lambda_config or lambda_config['lambdaArn'] == function_arn:
+                continue
+            if ':'.join(lambda_config['lambdaArn'].split(':')[:7]) != unqualified_arn:
+                continue
+            lambda_config['lambdaArn'] = function_arn
+            update = {
+                'gatewayIdentifier': gateway_id,
+                'targetId': target['targetId'],
+                'name': target['name'],
+                'targetConfiguration': target['targetConfiguration'],
+            }
+            if target.get('description'):
+                update['description'] = target['description']
+            if target.get('credentialProviderConfigurations'):
+                update['credentialProviderConfigurations'] = target['credentialProviderConfigurations']
+            client.update_gateway_target(**update)
+            print(f"✓ Gateway target {target['name']} -> {function_arn}")
+        if not response.get('nextToken'):
+            return
+        kwargs['nextToken'] = response['nextToken']
+
+def main():
+    print("=== Configure Lambda Warming ===\n")
+
+    function_name, region, provisioned_concurrency, alias, schedule, gateway_id = load_config()
+
+    print(f"Function: {function_name}")
+    print(f"Region: {region}")
+    print(f"Provisioned concurrency: {provisioned_concurrency}")
+    print(f"Warmer schedule: {schedule or 'disabled'}")
+
+    client = boto3.client('lambda', region_name=region)
+    try:
+        function_arn = client.get_function(FunctionName=function_name)['Configuration']['FunctionArn']
+
+        # Once the alias exists the Gateway invokes it, so keep it on the latest code even
+        # after provisioned concurrency is switched off
+        if provisioned_concurrency > 0 or alias_exists(client, function_name, alias):
+            function_arn = publish_alias(client, function_name, alias)
+            configure_provisioned_concurrency(client, function_name, alias, provisioned_concurrency)
+
+        configure_warmer(region, function_name, function_arn, schedule)
+        # Existing Gateway targets keep invoking whatever ARN they were created with
+        if gateway_id:
+            point_gateway_targets(region, gateway_id, function_arn)
+    except Exception as e:
+        print(f"✗ Failed to configure warming: {e}")
+        sys.exit(1)
+
+    print(f"LAMBDA_ARN={function_arn}")
+
+if __name__ == "__main__":
+    main()
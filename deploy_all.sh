@@ -28,7 +28,9 @@ fi
 
 # 加载环境变量
 echo -e "${BLUE}[1/8]${NC} 加载配置..."
-export $(cat .env | grep -v '^#' | grep -v '^$' | xargs)
+set -a
+. ./.env
+set +a
 
 # 验证必需的环境变量
 if [ -z "$KNOWLEDGE_BASE_ID" ] || [ "$KNOWLEDGE_BASE_ID" = "your-knowledge-base-id-here" ]; then
@@ -50,9 +52,19 @@ LAMBDA_FUNCTION_NAME=${LAMBDA_FUNCTION_NAME:-BedrockKBMCPProxy-${RANDOM_SUFFIX}}
 LAMBDA_ROLE_NAME=${LAMBDA_ROLE_NAME:-BedrockKBMCPLambdaRole-${RANDOM_SUFFIX}}
 KB_INCLUSION_TAG_KEY=${KB_INCLUSION_TAG_KEY:-mcp-multirag-kb}
 KB_TAG_VALUE=${KB_TAG_VALUE:-true}
+BEDROCK_KB_RERANKING_ENABLED=${BEDROCK_KB_RERANKING_ENABLED:-false}
 COGNITO_USER_POOL_NAME=${COGNITO_USER_POOL_NAME:-bedrock-kb-mcp-pool-${RANDOM_SUFFIX}}
 COGNITO_USERNAME=${COGNITO_USERNAME:-admin}
 
+# Lambda 环境变量（update-function-configuration 会整体替换，可选项为空时不传）
+LAMBDA_ENVIRONMENT="BEDROCK_REGION=$AWS_REGION,KNOWLEDGE_BASE_ID=$KNOWLEDGE_BASE_ID,KB_INCLUSION_TAG_KEY=$KB_INCLUSION_TAG_KEY,KB_TAG_VALUE=$KB_TAG_VALUE,BEDROCK_KB_RERANKING_ENABLED=$BEDROCK_KB_RERANKING_ENABLED"
+if [ -n "$RERANK_SCORER" ]; then
+    LAMBDA_ENVIRONMENT="$LAMBDA_ENVIRONMENT,RERANK_SCORER=$RERANK_SCORER"
+fi
+if [ -n "$RERANK_MODEL_ARN" ]; then
+    LAMBDA_ENVIRONMENT="$LAMBDA_ENVIRONMENT,RERANK_MODEL_ARN=$RERANK_MODEL_ARN"
+fi
+
 echo -e "${GREEN}✓${NC} 配置加载完成"
 echo "  - Knowledge Base ID: $KNOWLEDGE_BASE_ID"
 echo "  - AWS Region: $AWS_REGION"
@@ -114,7 +126,11 @@ EOF
       "bedrock-agent:GetKnowledgeBase",
       "bedrock-agent:ListDataSources",
       "bedrock-agent-runtime:Retrieve",
-      "bedrock:Retrieve"
+      "bedrock:Retrieve",
+      "bedrock:GetKnowledgeBase",
+      "bedrock:ListTagsForResource",
+      "bedrock:Rerank",
+      "bedrock:InvokeModel"
     ],
     "Resource": "*"
   }]
@@ -137,7 +153,12 @@ echo ""
 
 # 部署 Lambda 函数
 echo -e "${BLUE}[5/8]${NC} 部署 Lambda 函数..."
+# 生成知识库目录快照（失败不影响部署，Lambda 会回退到实时查询控制面）
+python3 build_kb_catalog.py 2>&1 | grep -E "✓|✗" || true
 zip -q -j lambda_proxy.zip lambda_proxy.py
+if [ -f kb_catalog.json ]; then
+    zip -q -j lambda_proxy.zip kb_catalog.json
+fi
 
 if aws lambda get-function --function-name $LAMBDA_FUNCTION_NAME --region $AWS_REGION 2>/dev/null >/dev/null; then
     echo -e "${YELLOW}⚠${NC} Lambda 函数已存在，更新代码..."
@@ -149,7 +170,7 @@ if aws lambda get-function --function-name $LAMBDA_FUNCTION_NAME --region $AWS_R
     
     aws lambda update-function-configuration \
       --function-name $LAMBDA_FUNCTION_NAME \
-      --environment "Variables={BEDROCK_REGION=$AWS_REGION,KNOWLEDGE_BASE_ID=$KNOWLEDGE_BASE_ID,KB_INCLUSION_TAG_KEY=$KB_INCLUSION_TAG_KEY,KB_TAG_VALUE=$KB_TAG_VALUE}" \
+      --environment "Variables={$LAMBDA_ENVIRONMENT}" \
       --region $AWS_REGION \
       >/dev/null
     
@@ -163,7 +184,7 @@ else
       --zip-file fileb://lambda_proxy.zip \
       --timeout 60 \
       --memory-size 256 \
-      --environment "Variables={BEDROCK_REGION=$AWS_REGION,KNOWLEDGE_BASE_ID=$KNOWLEDGE_BASE_ID,KB_INCLUSION_TAG_KEY=$KB_INCLUSION_TAG_KEY,KB_TAG_VALUE=$KB_TAG_VALUE}" \
+      --environment "Variables={$LAMBDA_ENVIRONMENT}" \
       --region $AWS_REGION \
       >/dev/null
     
@@ -171,6 +192,14 @@ else
 fi
 
 LAMBDA_ARN="arn:aws:lambda:$AWS_REGION:$ACCOUNT_ID:function:$LAMBDA_FUNCTION_NAME"
+
+# 预置并发 / 定时预热（可选）：启用预置并发时 Gateway 调用别名 ARN
+WARMING_OUTPUT=$(LAMBDA_FUNCTION_NAME=$LAMBDA_FUNCTION_NAME python3 configure_warming.py 2>&1) || true
+echo "$WARMING_OUTPUT" | grep -E "✓|✗" || true
+WARMED_LAMBDA_ARN=$(echo "$WARMING_OUTPUT" | grep "^LAMBDA_ARN=" | cut -d= -f2)
+if [ -n "$WARMED_LAMBDA_ARN" ]; then
+    LAMBDA_ARN=$WARMED_LAMBDA_ARN
+fi
 echo ""
 
 # 创建 Cognito User Pool（用于 OAuth 认证）
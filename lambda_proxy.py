@@ -2,10 +2,34 @@
 Lambda Proxy for Bedrock KB MCP Server
 直接实现Knowledge Base查询功能
 """
+import asyncio
+import contextvars
+import functools
+import heapq
+import itertools
 import json
-import boto3
+import math
 import os
-from typing import Dict, Any, List
+import random
+import re
+import threading
+import time
+import traceback
+import zlib
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Any, Iterator, List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # Lambda 运行时不带 numpy，语义缓存退化为纯 Python 实现
+    np = None
+
+try:
+    import orjson
+except ImportError:  # 未打包 orjson 时使用标准库 json
+    orjson = None
 
 # Configuration
 REGION = os.environ.get('BEDROCK_REGION', os.environ.get('AWS_REGION', 'us-east-1'))
@@ -13,180 +37,2607 @@ KB_TAG_KEY = os.environ.get('KB_INCLUSION_TAG_KEY', 'mcp-multirag-kb')
 KB_TAG_VALUE = os.environ.get('KB_TAG_VALUE', 'true')
 DEFAULT_KB_ID = os.environ.get('KNOWLEDGE_BASE_ID', 'PTTWEFYB6R')
 
-# Initialize AWS clients
-bedrock_agent = boto3.client('bedrock-agent', region_name=REGION)
-bedrock_agent_runtime = boto3.client('bedrock-agent-runtime', region_name=REGION)
+# ListKnowledgeBases 缓存配置（秒 / 条目数）
+KB_LIST_CACHE_TTL = float(os.environ.get('KB_LIST_CACHE_TTL', '300'))
+KB_LIST_CACHE_STALE_TTL = float(os.environ.get('KB_LIST_CACHE_STALE_TTL', '600'))
+KB_LIST_CACHE_MAX_ENTRIES = int(os.environ.get('KB_LIST_CACHE_MAX_ENTRIES', '16'))
+
+# 并发获取数据源的最大线程数
+KB_LIST_MAX_WORKERS = int(os.environ.get('KB_LIST_MAX_WORKERS', '8'))
+
+# 多知识库并发查询的最大线程数
+QUERY_MAX_WORKERS = int(os.environ.get('QUERY_MAX_WORKERS', '8'))
+
+# BatchQueryKnowledgeBases 单次调用的最大查询数与并发上限
+BATCH_MAX_QUERIES = int(os.environ.get('BATCH_MAX_QUERIES', '20'))
+BATCH_MAX_CONCURRENCY = int(os.environ.get('BATCH_MAX_CONCURRENCY', '8'))
+
+# 响应大小预算：响应体（转义后的 JSON）的最大字节数、单条结果最大字符数（0 表示不限制）
+RESPONSE_MAX_BYTES = int(os.environ.get('RESPONSE_MAX_BYTES', '0'))
+RESPONSE_MAX_CHUNK_CHARS = int(os.environ.get('RESPONSE_MAX_CHUNK_CHARS', '0'))
+MIN_SNIPPET_BYTES = 200
+OMITTED_NOTE_BYTES = 80
+# 为响应体的 JSON 外壳（content/type/text 字段与 _meta）预留的字节数
+RESPONSE_ENVELOPE_BYTES = 512
+
+# 重排序配置：超量召回 RERANK_OVERFETCH 倍候选后用 RERANK_SCORER 重排取 top-k
+RERANKING_ENABLED = os.environ.get('BEDROCK_KB_RERANKING_ENABLED', 'false').lower() == 'true'
+RERANK_SCORER = os.environ.get('RERANK_SCORER', 'bm25').lower()
+RERANK_OVERFETCH = max(1, int(os.environ.get('RERANK_OVERFETCH', '3')))
+RERANK_BM25_WEIGHT = float(os.environ.get('RERANK_BM25_WEIGHT', '0.5'))
+RERANK_MODEL_ARN = os.environ.get('RERANK_MODEL_ARN', '')
+MAX_RETRIEVE_RESULTS = 100
+
+# 近似重复折叠配置：同一 S3 对象内 shingle Jaccard 相似度达到阈值的片段只保留相关度最高的一个
+DEDUP_ENABLED = os.environ.get('DEDUP_ENABLED', 'false').lower() == 'true'
+DEDUP_THRESHOLD = float(os.environ.get('DEDUP_THRESHOLD', '0.6'))
+DEDUP_OVERFETCH = max(1, int(os.environ.get('DEDUP_OVERFETCH', '2')))
+DEDUP_SHINGLE_SIZE = 4
+
+# 对冲请求配置：首个 retrieve 超过最近延迟的 HEDGE_PERCENTILE 分位仍未返回时再发一个，
+# 对冲次数不超过请求数的 HEDGE_MAX_RATE
+HEDGE_ENABLED = os.environ.get('HEDGE_ENABLED', 'false').lower() == 'true'
+HEDGE_PERCENTILE = float(os.environ.get('HEDGE_PERCENTILE', '0.95'))
+HEDGE_MAX_RATE = float(os.environ.get('HEDGE_MAX_RATE', '0.1'))
+HEDGE_DEFAULT_DELAY_MS = float(os.environ.get('HEDGE_DEFAULT_DELAY_MS', '500'))
+HEDGE_MIN_DELAY_MS = float(os.environ.get('HEDGE_MIN_DELAY_MS', '50'))
+HEDGE_MIN_SAMPLES = 20
+HEDGE_SAMPLE_SIZE = 200
+
+# 请求合并（single-flight）：相同 (知识库, 查询, k, 过滤条件, 检索类型) 的并发检索共享一次在途 Bedrock 调用
+SINGLE_FLIGHT_ENABLED = os.environ.get('SINGLE_FLIGHT_ENABLED', 'true').lower() == 'true'
+
+# 仅属于单次请求的结果字段：不写入缓存，返回时放入 _meta
+REQUEST_META_KEYS = ('cache', 'hedge')
+
+# 支持的输出格式
+OUTPUT_FORMATS = ('markdown', 'json', 'compact')
+
+# Retrieve 元数据过滤与检索类型（透传给 vectorSearchConfiguration）
+SEARCH_TYPES = ('HYBRID', 'SEMANTIC')
+FILTER_LEAF_OPERATORS = (
+    'equals', 'notEquals', 'greaterThan', 'greaterThanOrEquals', 'lessThan', 'lessThanOrEquals',
+    'in', 'notIn', 'startsWith', 'listContains', 'stringContains'
+)
+FILTER_GROUP_OPERATORS = ('andAll', 'orAll')
+FILTER_MAX_DEPTH = 5
+
+# QueryKnowledgeBases 结果缓存配置
+# QUERY_CACHE_BACKEND 可选 sqlite，用于在进程内缓存之外增加外部缓存层
+QUERY_CACHE_TTL = float(os.environ.get('QUERY_CACHE_TTL', '300'))
+QUERY_CACHE_MAX_ENTRIES = int(os.environ.get('QUERY_CACHE_MAX_ENTRIES', '256'))
+QUERY_CACHE_BACKEND = os.environ.get('QUERY_CACHE_BACKEND', '').lower()
+QUERY_CACHE_PATH = os.environ.get('QUERY_CACHE_PATH', '/tmp/kb_query_cache.db')
+
+# 语义缓存：精确匹配未命中时，复用同一知识库内余弦相似度达到阈值的近似查询结果（有效期沿用 QUERY_CACHE_TTL）
+# 默认的本地哈希向量区分不了实体（只换一个国家名的查询相似度仍在 0.9 以上），
+# 因此使用它时还要求两条查询去掉停用词后的词元集合完全相同，只复用语序、空白、虚词不同的改写
+SEMANTIC_CACHE_ENABLED = os.environ.get('SEMANTIC_CACHE_ENABLED', 'false').lower() == 'true'
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get('SEMANTIC_CACHE_THRESHOLD', '0.9'))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.environ.get('SEMANTIC_CACHE_MAX_ENTRIES', '128'))
+SEMANTIC_CACHE_DIM = int(os.environ.get('SEMANTIC_CACHE_DIM', '512'))
+SEMANTIC_CACHE_MAX_PARTITIONS = 32
+
+# JSON 后端：auto（已安装 orjson 时使用）、orjson 或 json；只用于 compact 输出的序列化，响应体转义始终使用标准库
+JSON_BACKEND = os.environ.get('JSON_BACKEND', 'auto').lower()
+
+# 流式响应：首个分块立即输出，之后累积到 STREAM_CHUNK_BYTES 再输出
+STREAM_CHUNK_BYTES = int(os.environ.get('STREAM_CHUNK_BYTES', '16384'))
+
+# I/O 引擎：threads（默认，线程池并发）或 asyncio（在复用的事件循环上编排并发，
+# 阻塞的 botocore 调用卸载到共享线程池，ASYNC_MAX_WORKERS 即全局在途调用上限）
+IO_ENGINE = os.environ.get('IO_ENGINE', 'threads').lower()
+ASYNC_MAX_WORKERS = int(os.environ.get('ASYNC_MAX_WORKERS', '32'))
+
+# 知识库目录快照：按 ID / 名称 / 标签建立索引，解析知识库时无需调用控制面
+# 快照由 build_kb_catalog.py 生成并随部署包打包；文件不存在且 KB_CATALOG_FETCH=true 时在容器内首次使用时构建。
+# 快照超过 KB_CATALOG_TTL 秒后在后台增量刷新，0 表示不刷新
+KB_CATALOG_PATH = os.environ.get(
+    'KB_CATALOG_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'kb_catalog.json')
+)
+KB_CATALOG_FETCH = os.environ.get('KB_CATALOG_FETCH', 'false').lower() == 'true'
+KB_CATALOG_TTL = float(os.environ.get('KB_CATALOG_TTL', '900'))
+KB_CATALOG_VERSION = 1
+
+# 预热：收到 warmup 事件（如定时预热器）时只创建 client、预先建立连接并加载目录快照，不执行查询。
+# WARMUP_ON_INIT=auto 时仅在预置并发的初始化阶段（AWS_LAMBDA_INITIALIZATION_TYPE=provisioned-concurrency）预热，
+# true / false 强制开启 / 关闭；WARMUP_CONNECTIONS 为每个 endpoint 预先建立的连接数
+WARMUP_EVENT_KEY = 'warmup'
+WARMUP_ON_INIT = os.environ.get('WARMUP_ON_INIT', 'auto').lower()
+WARMUP_CONNECTIONS = max(0, int(os.environ.get('WARMUP_CONNECTIONS', '2')))
+WARMUP_SERVICES = ('bedrock-agent-runtime', 'bedrock-agent')
+
+# 控制面分页大小
+KB_PAGE_SIZE = 100
+DS_PAGE_SIZE = 100
+
+# 指标与性能分析：EMF 指标命名空间；PROFILE_MODE 可选 cprofile / tracemalloc，
+# 也可以通过事件中的 _profile 字段对单个请求开启
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'BedrockKBMCPProxy')
+PROFILE_MODE = os.environ.get('PROFILE_MODE', '').lower()
+PROFILE_TOP_N = 20
+
+# 重试、客户端限流与熔断配置
+RETRY_MAX_ATTEMPTS = max(1, int(os.environ.get('RETRY_MAX_ATTEMPTS', '4')))
+RETRY_BASE_DELAY = float(os.environ.get('RETRY_BASE_DELAY', '0.1'))
+RETRY_MAX_DELAY = float(os.environ.get('RETRY_MAX_DELAY', '2'))
+RATE_LIMIT_PER_KB = float(os.environ.get('RATE_LIMIT_PER_KB', '20'))
+RATE_LIMIT_BURST = float(os.environ.get('RATE_LIMIT_BURST', '20'))
+RATE_LIMIT_MAX_WAIT = float(os.environ.get('RATE_LIMIT_MAX_WAIT', '5'))
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', '5'))
+CIRCUIT_RESET_TIMEOUT = float(os.environ.get('CIRCUIT_RESET_TIMEOUT', '30'))
+CONTROL_PLANE_KEY = 'bedrock-agent'
+THROTTLING_ERROR_CODES = {
+    'ThrottlingException', 'TooManyRequestsException', 'Throttling',
+    'RequestLimitExceeded', 'ServiceQuotaExceededException'
+}
+TRANSIENT_ERROR_CODES = {
+    'InternalServerException', 'ServiceUnavailableException', 'ServiceUnavailable',
+    'InternalFailure', 'RequestTimeout', 'RequestTimeoutException'
+}
+TRANSIENT_EXCEPTION_NAMES = {
+    'EndpointConnectionError', 'ConnectionClosedError', 'ConnectTimeoutError',
+    'ReadTimeoutError', 'ConnectionError'
+}
+
+# 日志配置：级别、负载日志采样率（0~1）、单条负载最大字符数
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '1.0'))
+LOG_MAX_PAYLOAD_CHARS = int(os.environ.get('LOG_MAX_PAYLOAD_CHARS', '2048'))
+
+# botocore 连接与重试配置
+BOTO_MAX_POOL_CONNECTIONS = int(os.environ.get('BOTO_MAX_POOL_CONNECTIONS', '32'))
+BOTO_RETRY_MODE = os.environ.get('BOTO_RETRY_MODE', 'standard')
+# 重试由 call_bedrock 负责，botocore 默认只尝试一次，避免重试次数叠加
+BOTO_MAX_ATTEMPTS = int(os.environ.get('BOTO_MAX_ATTEMPTS', '1'))
+BOTO_CONNECT_TIMEOUT = float(os.environ.get('BOTO_CONNECT_TIMEOUT', '2'))
+BOTO_READ_TIMEOUT = float(os.environ.get('BOTO_READ_TIMEOUT', '30'))
+
+# 可选的自定义 endpoint（本地 stub / 基准测试使用）
+ENDPOINT_URLS = {
+    'bedrock-agent': os.environ.get('BEDROCK_AGENT_ENDPOINT_URL') or None,
+    'bedrock-agent-runtime': os.environ.get('BEDROCK_AGENT_RUNTIME_ENDPOINT_URL') or None,
+}
+
+# AWS clients 按服务懒加载，一次调用通常只用到其中一个
+_clients: Dict[str, Any] = {}
+_clients_lock = threading.Lock()
+
+def get_client(service_name: str):
+    """获取（必要时创建）指定服务的 boto3 client，并在容器生命周期内复用"""
+    client = _clients.get(service_name)
+    if client is not None:
+        return client
+    
+    with _clients_lock:
+        client = _clients.get(service_name)
+        if client is None:
+            # boto3 导入开销较大，推迟到第一次真正需要 client 时
+            import boto3
+            from botocore.config import Config
+            
+            client = boto3.client(
+                service_name,
+                region_name=REGION,
+                endpoint_url=ENDPOINT_URLS.get(service_name),
+                config=Config(
+                    max_pool_connections=BOTO_MAX_POOL_CONNECTIONS,
+                    tcp_keepalive=True,
+                    connect_timeout=BOTO_CONNECT_TIMEOUT,
+                    read_timeout=BOTO_READ_TIMEOUT,
+                    retries={'mode': BOTO_RETRY_MODE, 'max_attempts': BOTO_MAX_ATTEMPTS}
+                )
+            )
+            _clients[service_name] = client
+    return client
+
+def _prime_connections(client, count: int) -> int:
+    """
+    预先建立到 client endpoint 的连接（TCP + TLS 握手）并放回 botocore 的连接池，返回新建的连接数
+    
+    依赖 botocore / urllib3 的内部结构，结构不符时抛出异常，由调用方忽略；
+    池中仍然存活的连接直接复用，因此重复调用只会补足缺少的连接。
+    """
+    endpoint = client._endpoint
+    session = endpoint.http_session
+    url = endpoint.host
+    manager = session._get_connection_manager(url, session._proxy_config.proxy_url_for(url))
+    pool = manager.connection_from_url(url)
+    session._setup_ssl_cert(pool, url, session._verify)
+    
+    connections = [pool._get_conn() for _ in range(min(count, BOTO_MAX_POOL_CONNECTIONS))]
+    opened = 0
+    try:
+        for conn in connections:
+            if getattr(conn, 'sock', None) is None:
+                conn.connect()
+                opened += 1
+    finally:
+        for conn in connections:
+            pool._put_conn(conn)
+    return opened
+
+# 结构化日志：每行一个 JSON 对象，未达到日志级别或未被采样的行不做任何序列化
+LOG_LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40, 'CRITICAL': 50}
+
+def log_enabled(level: str) -> bool:
+    return LOG_LEVELS[level] >= LOG_LEVELS.get(LOG_LEVEL, 20)
+
+def _json_default(value: Any) -> Any:
+    """json.dumps 的 default：检索结果序列化为字典，其它未知类型转为字符串"""
+    if isinstance(value, RetrievalResult):
+        return value.to_dict()
+    return str(value)
+
+def _use_orjson() -> bool:
+    return orjson is not None and JSON_BACKEND != 'json'
+
+# 复用编码器实例：带参数的 json.dumps 每次调用都会新建 JSONEncoder
+_JSON_ENCODER = json.JSONEncoder(ensure_ascii=False, default=_json_default)
+_COMPACT_JSON_ENCODER = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=_json_default)
+
+def log(level: str, message: str, **fields):
+    """输出一行结构化日志"""
+    if not log_enabled(level):
+        return
+    print(json.dumps({'level': level, 'message': message, **fields}, ensure_ascii=False, default=str))
+
+def log_payload(level: str, message: str, payload: Any, sampled: bool = True, **fields):
+    """
+    按采样输出大体积负载（事件、查询结果），超过 LOG_MAX_PAYLOAD_CHARS 的部分被截断
+    
+    级别未启用或本次请求未被采样时直接返回，不序列化 payload。
+    """
+    if not sampled or not log_enabled(level):
+        return
+    text = json.dumps(payload, ensure_ascii=False, default=_json_default)
+    if len(text) > LOG_MAX_PAYLOAD_CHARS:
+        fields['truncated_chars'] = len(text) - LOG_MAX_PAYLOAD_CHARS
+        text = text[:LOG_MAX_PAYLOAD_CHARS]
+    log(level, message, payload=text, **fields)
+
+def should_sample() -> bool:
+    """按 LOG_SAMPLE_RATE 决定本次请求是否记录负载日志"""
+    return LOG_SAMPLE_RATE >= 1 or random.random() < LOG_SAMPLE_RATE
+
+class RequestMetrics:
+    """
+    单次调用的分阶段耗时与属性，调用结束时以 CloudWatch Embedded Metric Format 输出
+    
+    各阶段耗时为累计值：并发执行的阶段（如多个 list_data_sources）会叠加。
+    """
+    
+    def __init__(self, cold_start: bool):
+        self.started_at = time.perf_counter()
+        self.tool = 'Unknown'
+        self.cold_start = cold_start
+        self.result_count = 0
+        self.response_bytes = 0
+        self.cache_hit = False
+        self.error = False
+        self.first_byte_at: Optional[float] = None
+        self.coalesced = 0
+        self.hedged = 0
+        self.hedge_won = 0
+        self.spans: Dict[str, float] = {}
+        self.span_counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+    
+    def add_span(self, name: str, seconds: float):
+        with self._lock:
+            self.spans[name] = self.spans.get(name, 0.0) + seconds
+            self.span_counts[name] = self.span_counts.get(name, 0) + 1
+    
+    def record_coalesced(self):
+        with self._lock:
+            self.coalesced += 1
+    
+    def record_hedge(self):
+        with self._lock:
+            self.hedged += 1
+    
+    def record_hedge_win(self):
+        with self._lock:
+            self.hedge_won += 1
+    
+    def emit(self, request_id: Optional[str]):
+        if not METRICS_ENABLED:
+            return
+        
+        values = {f"{name}_ms": round(seconds * 1000, 3) for name, seconds in self.spans.items()}
+        values['total_ms'] = round((time.perf_counter() - self.started_at) * 1000, 3)
+        if self.first_byte_at is not None:
+            values['first_byte_ms'] = round((self.first_byte_at - self.started_at) * 1000, 3)
+        units = {name: 'Milliseconds' for name in values}
+        values.update({
+            'result_count': self.result_count,
+            'response_bytes': self.response_bytes,
+            'cache_hit': int(self.cache_hit),
+            'coalesced': self.coalesced,
+            'hedged': self.hedged,
+            'hedge_won': self.hedge_won,
+            'cold_start': int(self.cold_start),
+            'error': int(self.error)
+        })
+        units.update({'result_count': 'Count', 'response_bytes': 'Bytes',
+                      'cache_hit': 'Count', 'coalesced': 'Count', 'hedged': 'Count', 'hedge_won': 'Count',
+                      'cold_start': 'Count', 'error': 'Count'})
+        
+        print(json.dumps({
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [['tool']],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, unit in units.items()]
+                }]
+            },
+            'tool': self.tool,
+            'request_id': request_id,
+            'span_counts': self.span_counts,
+            **values
+        }))
+
+# 当前请求的指标保存在 contextvar 中：同一进程内并发调用 handler 时互不干扰，
+# 请求内的线程池任务通过 bind_context 继承；后台刷新线程没有当前请求，不记录 span
+_current_metrics: contextvars.ContextVar[Optional[RequestMetrics]] = contextvars.ContextVar(
+    'current_metrics', default=None
+)
+_cold_start = True
+
+@contextmanager
+def span(name: str):
+    """记录一个阶段的耗时到当前请求的指标中（无当前请求时不记录）"""
+    metrics = _current_metrics.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if metrics is not None:
+            metrics.add_span(name, time.perf_counter() - start)
+
+def bind_context(fn):
+    """
+    让提交到线程池的 fn 在调用方的 contextvars 上下文中执行（线程池线程不会自动继承）
+    
+    每次调用使用上下文的独立副本，同一个包装函数可以被多个线程同时执行。
+    """
+    context = contextvars.copy_context()
+    
+    def run(*args, **kwargs):
+        return context.copy().run(fn, *args, **kwargs)
+    return run
+
+def start_profiler(mode: str):
+    """按需启动 cProfile 或 tracemalloc，返回 (模式, profiler)；mode 为空时不做任何事"""
+    if mode == 'cprofile':
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return mode, profiler
+    if mode == 'tracemalloc':
+        import tracemalloc
+        tracemalloc.start()
+        return mode, None
+    return None
+
+def stop_profiler(profiler, request_id: Optional[str]):
+    """停止 profiler 并把结果写入日志"""
+    if profiler is None:
+        return
+    
+    mode, instance = profiler
+    if mode == 'cprofile':
+        import io
+        import pstats
+        instance.disable()
+        stream = io.StringIO()
+        pstats.Stats(instance, stream=stream).sort_stats('cumulative').print_stats(PROFILE_TOP_N)
+        print(json.dumps({'level': 'INFO', 'message': "cProfile", 'request_id': request_id,
+                          'profile': stream.getvalue()}, ensure_ascii=False))
+    else:
+        import tracemalloc
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        top = [str(stat) for stat in snapshot.statistics('lineno')[:PROFILE_TOP_N]]
+        print(json.dumps({'level': 'INFO', 'message': "tracemalloc", 'request_id': request_id,
+                          'current_bytes': current, 'peak_bytes': peak, 'top': top}, ensure_ascii=False))
+
+class RateLimitExceeded(Exception):
+    """客户端限流等待超时"""
+
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态，快速失败"""
+
+class TokenBucket:
+    """
+    自适应令牌桶限流器（AIMD）
+    
+    收到限流错误时速率减半，成功调用后线性恢复，直至配置的上限。
+    """
+    
+    def __init__(self, rate: float, capacity: float, min_rate: float = 0.5):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+    
+    def acquire(self, timeout: float) -> bool:
+        """获取一个令牌，最多等待 timeout 秒"""
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+    
+    def on_throttled(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+    
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+class CircuitBreaker:
+    """
+    熔断器：连续失败达到阈值后打开，reset_timeout 后进入半开状态，
+    放行一个探测请求，成功则关闭，失败则重新打开
+    """
+    
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self._probe_thread: Optional[int] = None
+        self._lock = threading.Lock()
+    
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._probing or time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self._probing = True
+            self._probe_thread = threading.get_ident()
+            return True
+    
+    def abandon_probe(self):
+        """当前线程的探测请求没有得到结果（如被客户端限流拒绝）时释放探测名额，下一个请求可以重新探测"""
+        with self._lock:
+            if self._probing and self._probe_thread == threading.get_ident():
+                self._probing = False
+    
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+    
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+_rate_limiters: Dict[str, TokenBucket] = {}
+_circuit_breakers: Dict[str, CircuitBreaker] = {}
+_resilience_lock = threading.Lock()
+
+def _resilience_for(key: str) -> Tuple[Optional[TokenBucket], CircuitBreaker]:
+    """获取（必要时创建）某个知识库或控制面对应的限流器与熔断器"""
+    with _resilience_lock:
+        if key not in _circuit_breakers:
+            _circuit_breakers[key] = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+            if RATE_LIMIT_PER_KB > 0:
+                _rate_limiters[key] = TokenBucket(RATE_LIMIT_PER_KB, max(1.0, RATE_LIMIT_BURST))
+        return _rate_limiters.get(key), _circuit_breakers[key]
+
+def _error_code(error: Exception) -> str:
+    response = getattr(error, 'response', None) or {}
+    return response.get('Error', {}).get('Code', '')
+
+def _is_throttling(error: Exception) -> bool:
+    return _error_code(error) in THROTTLING_ERROR_CODES
+
+def _is_retryable(error: Exception) -> bool:
+    """限流、服务端错误和连接/超时错误可以重试，参数错误等不重试"""
+    if _is_throttling(error) or _error_code(error) in TRANSIENT_ERROR_CODES:
+        return True
+    return type(error).__name__ in TRANSIENT_EXCEPTION_NAMES
+
+def call_bedrock(key: str, operation, **kwargs):
+    """
+    带限流、重试和熔断的 Bedrock API 调用
+    
+    Args:
+        key: 限流与熔断的粒度，检索为知识库ID，控制面调用为 CONTROL_PLANE_KEY
+        operation: boto3 client 方法
+    """
+    bucket, breaker = _resilience_for(key)
+    # 先取令牌再检查熔断器：被限流拒绝的请求不会占用半开状态的探测名额
+    if bucket is not None and not bucket.acquire(RATE_LIMIT_MAX_WAIT):
+        raise RateLimitExceeded(f"Client-side rate limit exceeded for {key}")
+    if not breaker.allow():
+        raise CircuitOpenError(f"Circuit open for {key}, failing fast")
+    
+    try:
+        for attempt in range(RETRY_MAX_ATTEMPTS):
+            if attempt and bucket is not None and not bucket.acquire(RATE_LIMIT_MAX_WAIT):
+                raise RateLimitExceeded(f"Client-side rate limit exceeded for {key}")
+            
+            try:
+                response = operation(**kwargs)
+            except Exception as e:
+                if not _is_retryable(e):
+                    # 参数、权限类错误不代表后端故障，不计入熔断
+                    breaker.record_success()
+                    raise
+                if bucket is not None and _is_throttling(e):
+                    bucket.on_throttled()
+                if attempt == RETRY_MAX_ATTEMPTS - 1:
+                    breaker.record_failure()
+                    raise
+                
+                # full jitter 指数退避
+                delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+                log('WARNING', "Retrying Bedrock call", key=key, attempt=attempt + 1,
+                    error_code=_error_code(e) or type(e).__name__, delay=round(delay, 3))
+                time.sleep(delay)
+                continue
+            
+            breaker.record_success()
+            if bucket is not None:
+                bucket.on_success()
+            return response
+    finally:
+        # 任何未记录结果的退出路径（重试时被限流拒绝等）都要释放探测名额，否则熔断器永远不会再放行
+        breaker.abandon_probe()
+
+_event_loop: Optional[asyncio.AbstractEventLoop] = None
+_async_executor: Optional[ThreadPoolExecutor] = None
+_async_lock = threading.Lock()
+
+def async_engine_enabled() -> bool:
+    """asyncio 引擎只驱动主线程（Lambda handler 所在线程），后台刷新等其它线程使用线程池实现"""
+    return IO_ENGINE == 'asyncio' and threading.current_thread() is threading.main_thread()
+
+def run_async(coro):
+    """在主线程的事件循环上运行协程，事件循环在热启动调用之间复用"""
+    global _event_loop
+    if _event_loop is None or _event_loop.is_closed():
+        _event_loop = asyncio.new_event_loop()
+    return _event_loop.run_until_complete(coro)
+
+async def to_thread(fn, *args):
+    """把阻塞调用卸载到共享线程池"""
+    global _async_executor
+    with _async_lock:
+        if _async_executor is None:
+            _async_executor = ThreadPoolExecutor(max_workers=ASYNC_MAX_WORKERS, thread_name_prefix='kb-io')
+    call = bind_context(functools.partial(fn, *args))
+    return await asyncio.get_running_loop().run_in_executor(_async_executor, call)
+
+async def gather_limited(fn, items, limit: int) -> list:
+    """
+    在同一个 TaskGroup 内对 items 并发执行协程函数 fn，最多 limit 个同时运行
+    
+    结果顺序与输入一致；任一任务抛出异常时取消其余任务。
+    """
+    semaphore = asyncio.Semaphore(max(1, limit))
+    
+    async def run(item):
+        async with semaphore:
+            return await fn(item)
+    
+    async with asyncio.TaskGroup() as group:
+        tasks = [group.create_task(run(item)) for item in items]
+    return [task.result() for task in tasks]
+
+def map_concurrently(fn, items: list, max_workers: int) -> list:
+    """并发执行阻塞函数 fn，结果顺序与输入一致；asyncio 引擎下由事件循环编排，否则使用线程池"""
+    if async_engine_enabled():
+        return run_async(gather_limited(lambda item: to_thread(fn, item), items, max_workers))
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items)))) as executor:
+        return list(executor.map(bind_context(fn), items))
+
+class TTLCache:
+    """
+    进程内 TTL + LRU 缓存，模块级实例在 Lambda 热启动调用之间复用
+    
+    - 超过 ttl 但未超过 ttl + stale_ttl 的条目视为"过期可用"（stale-while-revalidate）
+    - 条目数超过 max_entries 时淘汰最久未使用的条目
+    """
+    
+    def __init__(self, ttl: float, max_entries: int, stale_ttl: float = 0):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max(1, max_entries)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key) -> Tuple[bool, Any, bool]:
+        """返回 (是否命中, 值, 是否过期)"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return False, None, False
+            
+            stored_at, value = entry
+            age = time.monotonic() - stored_at
+            if age > self.ttl + self.stale_ttl:
+                del self._data[key]
+                return False, None, False
+            
+            self._data.move_to_end(key)
+            return True, value, age > self.ttl
+    
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+_kb_list_cache = TTLCache(KB_LIST_CACHE_TTL, KB_LIST_CACHE_MAX_ENTRIES, KB_LIST_CACHE_STALE_TTL)
+_kb_list_refreshing = set()
+_kb_list_refresh_lock = threading.Lock()
+
+def _refresh_kb_list_cache(cache_key, fetch):
+    """后台刷新缓存条目，刷新失败时保留旧值"""
+    try:
+        _kb_list_cache.set(cache_key, fetch())
+    except Exception as e:
+        log('WARNING', "Background refresh of knowledge base list failed", error=str(e))
+    finally:
+        with _kb_list_refresh_lock:
+            _kb_list_refreshing.discard(cache_key)
+
+def _cached_kb_list(cache_key, fetch):
+    """
+    从缓存读取知识库列表
+    - 新鲜命中：直接返回
+    - 过期命中：返回旧值并在后台线程刷新
+    - 未命中：同步调用 fetch 并写入缓存
+    """
+    hit, value, stale = _kb_list_cache.get(cache_key)
+    if hit:
+        if stale:
+            with _kb_list_refresh_lock:
+                start_refresh = cache_key not in _kb_list_refreshing
+                _kb_list_refreshing.add(cache_key)
+            if start_refresh:
+                threading.Thread(
+                    target=_refresh_kb_list_cache,
+                    args=(cache_key, fetch),
+                    daemon=True
+                ).start()
+        return value
+    
+    value = fetch()
+    _kb_list_cache.set(cache_key, value)
+    return value
+
+def list_knowledge_bases(max_results: Optional[int] = None, next_token: Optional[str] = None):
+    """
+    列出Knowledge Bases（带热启动缓存）
+    
+    Args:
+        max_results: 最多返回的知识库数量，None 表示全部
+        next_token: 上一次调用返回的分页游标
+    
+    数据源状态会随同步变化，始终走控制面与 KB_LIST_CACHE_TTL 缓存，不使用目录快照。
+    """
+    cache_key = ('knowledge_bases', max_results, next_token)
+    return _cached_kb_list(
+        cache_key,
+        lambda: _fetch_knowledge_bases(max_results, next_token)
+    )
+
+def _paginate(operation, result_key: str, **kwargs):
+    """按 nextToken 逐页调用控制面 API，惰性产出每条记录"""
+    while True:
+        response = call_bedrock(CONTROL_PLANE_KEY, operation, **kwargs)
+        yield from response.get(result_key, [])
+        token = response.get('nextToken')
+        if not token:
+            return
+        kwargs['nextToken'] = token
+
+def _list_data_sources(kb_id):
+    """获取单个知识库的全部数据源，失败时返回空列表"""
+    try:
+        with span('list_data_sources'):
+            return [
+                {
+                    'id': ds['dataSourceId'],
+                    'name': ds['name'],
+                    'status': ds['status']
+                }
+                for ds in _paginate(
+                    get_client('bedrock-agent').list_data_sources,
+                    'dataSourceSummaries',
+                    knowledgeBaseId=kb_id,
+                    maxResults=DS_PAGE_SIZE
+                )
+            ]
+    except Exception as e:
+        log('WARNING', "Error getting data sources", knowledge_base_id=kb_id, error=str(e))
+        return []
+
+def iter_knowledge_base_pages(max_results: Optional[int] = None, next_token: Optional[str] = None):
+    """
+    惰性分页遍历知识库，每到达一页就产出 (知识库列表, 下一页游标)
+    
+    页大小按剩余配额收缩，使得在 max_results 处截断时返回的游标
+    恰好指向下一条未返回的知识库。
+    """
+    remaining = max_results
+    while remaining is None or remaining > 0:
+        page_size = KB_PAGE_SIZE if remaining is None else min(KB_PAGE_SIZE, remaining)
+        kwargs = {'maxResults': page_size}
+        if next_token:
+            kwargs['nextToken'] = next_token
+        
+        with span('list_knowledge_bases'):
+            response = call_bedrock(CONTROL_PLANE_KEY, get_client('bedrock-agent').list_knowledge_bases, **kwargs)
+        summaries = response.get('knowledgeBaseSummaries', [])
+        next_token = response.get('nextToken')
+        
+        # 并发获取本页各知识库的数据源，输出顺序与输入一致
+        kb_ids = [kb['knowledgeBaseId'] for kb in summaries]
+        if len(kb_ids) > 1:
+            all_data_sources = map_concurrently(_list_data_sources, kb_ids, KB_LIST_MAX_WORKERS)
+        else:
+            all_data_sources = [_list_data_sources(kb_id) for kb_id in kb_ids]
+        
+        kbs = [
+            {
+                'id': kb['knowledgeBaseId'],
+                'name': kb['name'],
+                'description': kb.get('description', ''),
+                'data_sources': data_sources
+            }
+            for kb, data_sources in zip(summaries, all_data_sources)
+        ]
+        yield kbs, next_token
+        
+        if not next_token:
+            return
+        if remaining is not None:
+            remaining -= len(summaries)
+
+def _fetch_knowledge_bases(max_results: Optional[int] = None, next_token: Optional[str] = None):
+    """从 Bedrock 控制面获取知识库及其数据源"""
+    try:
+        kbs = []
+        for page, next_token in iter_knowledge_base_pages(max_results, next_token):
+            kbs.extend(page)
+        
+        result = {'knowledge_bases': kbs}
+        if next_token:
+            result['next_token'] = next_token
+        return result
+    
+    except Exception as e:
+        raise Exception(f"Failed to list knowledge bases: {str(e)}")
+
+class KBCatalog:
+    """
+    知识库目录快照，按 ID、名称（不区分大小写）和标签建立索引
+    
+    条目字段：id, name, description, status, updated_at, arn, tags, data_sources
+    """
+    
+    def __init__(self, knowledge_bases: List[Dict[str, Any]], generated_at: float):
+        self.knowledge_bases = knowledge_bases
+        self.generated_at = generated_at
+        self.by_id = {kb['id']: kb for kb in knowledge_bases}
+        self.by_name = {kb['name'].lower(): kb for kb in knowledge_bases}
+        self.by_tag: Dict[Tuple[str, str], List[str]] = {}
+        for kb in knowledge_bases:
+            for key, value in kb.get('tags', {}).items():
+                self.by_tag.setdefault((key, value), []).append(kb['id'])
+    
+    def resolve(self, id_or_name: str) -> Optional[str]:
+        """按 ID 或名称查找知识库ID，找不到返回 None"""
+        if id_or_name in self.by_id:
+            return id_or_name
+        kb = self.by_name.get(id_or_name.lower())
+        return kb['id'] if kb else None
+    
+    def tagged(self, key: str, value: str) -> List[str]:
+        return list(self.by_tag.get((key, value), []))
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'version': KB_CATALOG_VERSION,
+            'generated_at': self.generated_at,
+            'knowledge_bases': self.knowledge_bases
+        }
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'KBCatalog':
+        if data.get('version') != KB_CATALOG_VERSION:
+            raise ValueError(f"Unsupported KB catalog version: {data.get('version')}")
+        return cls(data['knowledge_bases'], float(data['generated_at']))
+
+def load_kb_catalog(path: str) -> Optional[KBCatalog]:
+    """读取目录快照文件，文件不存在或无法解析时返回 None"""
+    try:
+        with open(path, encoding='utf-8') as f:
+            return KBCatalog.from_dict(json.load(f))
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        log('WARNING', "Failed to load KB catalog", path=path, error=str(e))
+        return None
+
+def save_kb_catalog(catalog: KBCatalog, path: str):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(catalog.to_dict(), f, ensure_ascii=False, separators=(',', ':'), default=str)
+
+def _catalog_entry(summary: Dict[str, Any], previous: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    构建单个知识库的目录条目；updatedAt 未变化时复用上一版的 ARN，省去 GetKnowledgeBase
+    
+    数据源同步或新增不会改变知识库的 updatedAt，因此数据源与标签每次都重新读取。
+    """
+    client = get_client('bedrock-agent')
+    kb_id = summary['knowledgeBaseId']
+    updated_at = str(summary.get('updatedAt', ''))
+    
+    if previous and previous.get('updated_at') == updated_at and previous.get('arn'):
+        arn = previous['arn']
+    else:
+        arn = call_bedrock(
+            CONTROL_PLANE_KEY, client.get_knowledge_base, knowledgeBaseId=kb_id
+        )['knowledgeBase']['knowledgeBaseArn']
+    data_sources = _list_data_sources(kb_id)
+    
+    try:
+        tags = call_bedrock(CONTROL_PLANE_KEY, client.list_tags_for_resource, resourceArn=arn).get('tags', {})
+    except Exception as e:
+        log('WARNING', "Error getting tags", knowledge_base_id=kb_id, error=str(e))
+        tags = previous.get('tags', {}) if previous else {}
+    
+    return {
+        'id': kb_id,
+        'name': summary['name'],
+        'description': summary.get('description', ''),
+        'status': summary.get('status', ''),
+        'updated_at': updated_at,
+        'arn': arn,
+        'tags': tags,
+        'data_sources': data_sources
+    }
+
+def build_kb_catalog(previous: Optional[KBCatalog] = None) -> Tuple[KBCatalog, Dict[str, List[str]]]:
+    """
+    从控制面构建目录快照，传入 previous 时与上一版做增量对比
+    
+    返回 (新目录, 差异)，差异包含 added / updated / removed 的知识库ID。
+    """
+    summaries = list(_paginate(
+        get_client('bedrock-agent').list_knowledge_bases, 'knowledgeBaseSummaries', maxResults=KB_PAGE_SIZE
+    ))
+    previous_entries = previous.by_id if previous else {}
+    entries = map_concurrently(
+        lambda summary: _catalog_entry(summary, previous_entries.get(summary['knowledgeBaseId'])),
+        summaries, KB_LIST_MAX_WORKERS
+    ) if summaries else []
+    
+    entry_ids = {entry['id'] for entry in entries}
+    diff = {
+        'added': [entry['id'] for entry in entries if entry['id'] not in previous_entries],
+        'updated': [
+            entry['id'] for entry in entries
+            if entry['id'] in previous_entries and entry != previous_entries[entry['id']]
+        ],
+        'removed': [kb_id for kb_id in previous_entries if kb_id not in entry_ids]
+    }
+    return KBCatalog(entries, time.time()), diff
+
+_kb_catalog: Optional[KBCatalog] = None
+_kb_catalog_loaded = False
+_kb_catalog_refreshing = False
+_kb_catalog_attempted_at = 0.0
+_kb_catalog_lock = threading.Lock()
+
+def _refresh_kb_catalog():
+    """增量刷新目录快照，失败时保留旧快照"""
+    global _kb_catalog, _kb_catalog_attempted_at
+    _kb_catalog_attempted_at = time.time()
+    try:
+        catalog, diff = build_kb_catalog(_kb_catalog)
+    except Exception as e:
+        log('WARNING', "KB catalog refresh failed", error=str(e))
+        return
+    _kb_catalog = catalog
+    log('INFO', "KB catalog refreshed", knowledge_bases=len(catalog.knowledge_bases),
+        **{key: len(kb_ids) for key, kb_ids in diff.items()})
+
+def _refresh_kb_catalog_in_background():
+    global _kb_catalog_refreshing
+    try:
+        _refresh_kb_catalog()
+    finally:
+        with _kb_catalog_lock:
+            _kb_catalog_refreshing = False
+
+def get_kb_catalog() -> Optional[KBCatalog]:
+    """
+    返回当前容器的目录快照，未启用时返回 None
+    
+    快照每个容器只加载一次；超过 KB_CATALOG_TTL 后先返回旧快照，并在后台增量刷新。
+    """
+    global _kb_catalog, _kb_catalog_loaded, _kb_catalog_refreshing
+    with _kb_catalog_lock:
+        if not _kb_catalog_loaded:
+            _kb_catalog_loaded = True
+            _kb_catalog = load_kb_catalog(KB_CATALOG_PATH)
+            if _kb_catalog is None and KB_CATALOG_FETCH:
+                _refresh_kb_catalog()
+        
+        catalog = _kb_catalog
+        if (catalog is not None and KB_CATALOG_TTL > 0 and not _kb_catalog_refreshing
+                and time.time() - max(catalog.generated_at, _kb_catalog_attempted_at) > KB_CATALOG_TTL):
+            _kb_catalog_refreshing = True
+            threading.Thread(target=_refresh_kb_catalog_in_background, daemon=True).start()
+    return catalog
+
+def resolve_knowledge_base_id(id_or_name: str) -> str:
+    """通过目录快照把知识库名称解析为ID；没有快照或找不到时原样返回"""
+    catalog = get_kb_catalog()
+    if catalog is None:
+        return id_or_name
+    return catalog.resolve(id_or_name) or id_or_name
+
+class SingleFlight:
+    """
+    合并并发的相同调用：同一 key 在途期间，后到的调用等待首个调用的结果或异常，不再重复调用
+    """
+    
+    def __init__(self):
+        self._calls: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._stats = {'calls': 0, 'coalesced': 0}
+    
+    def do(self, key: str, fn) -> Tuple[Any, bool]:
+        """返回 (结果, 是否复用了其它调用的结果)"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+                self._stats['calls'] += 1
+            else:
+                self._stats['coalesced'] += 1
+        
+        if not leader:
+            return call.result(), True
+        
+        try:
+            result = fn()
+        except Exception as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                del self._calls[key]
+    
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats)
+
+class RetrievalResult:
+    """
+    单条检索结果：直接引用 Retrieve 响应中的字段，不复制为新字典
+    
+    vector_score 仅在重排序后设置，knowledge_base_id 仅在多知识库查询时设置。
+    提供只读的映射接口（keys / [] / get / in），dict(result) 得到与字典表示相同的内容。
+    """
+    
+    __slots__ = ('content', 'score', 'location', 'metadata', 'vector_score', 'knowledge_base_id')
+    
+    def __init__(self, content: str, score: float, location: Dict[str, Any], metadata: Dict[str, Any],
+                 vector_score: Optional[float] = None, knowledge_base_id: Optional[str] = None):
+        self.content = content
+        self.score = score
+        self.location = location
+        self.metadata = metadata
+        self.vector_score = vector_score
+        self.knowledge_base_id = knowledge_base_id
+    
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'RetrievalResult':
+        """由字典表示（如外部缓存后端中的 JSON）构造"""
+        return cls(data.get('content', ''), data.get('score', 0), data.get('location', {}), data.get('metadata', {}),
+                   data.get('vector_score'), data.get('knowledge_base_id'))
+    
+    def replace(self, **changes) -> 'RetrievalResult':
+        """返回修改了部分字段的副本，其余字段共享引用"""
+        clone = RetrievalResult(self.content, self.score, self.location, self.metadata,
+                                self.vector_score, self.knowledge_base_id)
+        for name, value in changes.items():
+            setattr(clone, name, value)
+        return clone
+    
+    def keys(self) -> List[str]:
+        return list(self.to_dict())
+    
+    def __getitem__(self, key: str) -> Any:
+        value = getattr(self, key, None) if key in self.__slots__ else None
+        if value is None:
+            raise KeyError(key)
+        return value
+    
+    def get(self, key: str, default: Any = None) -> Any:
+        value = getattr(self, key, None) if key in self.__slots__ else None
+        return default if value is None else value
+    
+    def __contains__(self, key: str) -> bool:
+        return key in self.__slots__ and getattr(self, key) is not None
+    
+    def to_dict(self) -> Dict[str, Any]:
+        data = {'content': self.content, 'score': self.score, 'location': self.location, 'metadata': self.metadata}
+        if self.vector_score is not None:
+            data['vector_score'] = self.vector_score
+        if self.knowledge_base_id is not None:
+            data['knowledge_base_id'] = self.knowledge_base_id
+        return data
+    
+    def __repr__(self) -> str:
+        return f"RetrievalResult({self.to_dict()!r})"
+
+class SQLiteCacheBackend:
+    """
+    基于 sqlite 文件的外部查询缓存后端
+    
+    外部后端只需实现 get(key) -> Optional[dict] 与 set(key, value, ttl)，
+    可通过 set_query_cache_backend() 替换为 Redis/DynamoDB 等实现。
+    """
+    
+    def __init__(self, path: str):
+        import sqlite3
+        
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS query_cache '
+            '(key TEXT PRIMARY KEY, expires_at REAL NOT NULL, value TEXT NOT NULL)'
+        )
+        self._conn.commit()
+    
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT expires_at, value FROM query_cache WHERE key = ?', (key,)
+            ).fetchone()
+        if row is None or row[0] < time.time():
+            return None
+        return json.loads(row[1])
+    
+    def set(self, key: str, value: Dict[str, Any], ttl: float):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO query_cache (key, expires_at, value) VALUES (?, ?, ?)',
+                (key, time.time() + ttl, json.dumps(value, default=_json_default))
+            )
+            self._conn.commit()
+
+def hashing_embed(text: str, dim: int = SEMANTIC_CACHE_DIM) -> List[float]:
+    """
+    本地哈希向量化：词元与相邻词元二元组经 crc32 哈希到 dim 维（带符号），无需网络
+
+    只用于判断改写后的查询是否与已缓存查询足够接近，不追求语义表示质量。
+    """
+    tokens = _tokenize(text)
+    features = tokens + [f'{a} {b}' for a, b in zip(tokens, tokens[1:])]
+    vector = [0.0] * dim
+    for feature in features:
+        h = zlib.crc32(feature.encode('utf-8'))
+        vector[h % dim] += 1.0 if h & 0x80000000 else -1.0
+    return vector
+
+# 比较语义缓存词元集合时忽略的虚词
+_SEMANTIC_STOPWORDS = frozenset((
+    'a', 'an', 'the', 'is', 'are', 'was', 'were', 'be', 'do', 'does', 'did', 'what', 'which', 'how', 'who',
+    'when', 'where', 'why', 'of', 'for', 'to', 'in', 'on', 'at', 'by', 'with', 'about', 'and', 'or',
+    'can', 'could', 'i', 'me', 'my', 'we', 'our', 'you', 'your', 'it', 'its', 'this', 'that', 'please', 'tell',
+    '的', '了', '吗', '呢', '吧', '啊', '是', '在', '和', '与', '请', '我', '们', '怎', '么', '什', '如', '何',
+))
+
+def semantic_terms(text: str) -> frozenset:
+    """查询去掉停用词后的词元集合，用于限制哈希向量语义缓存只匹配用词相同的改写"""
+    return frozenset(token for token in _tokenize(text) if token not in _SEMANTIC_STOPWORDS)
+
+class _SemanticPartition:
+    """单个分区的定长向量矩阵；有 numpy 时矩阵运算一次求出全部相似度"""
+    
+    def __init__(self, dim: int, capacity: int):
+        self.capacity = capacity
+        self.size = 0
+        self.values = [None] * capacity
+        self.terms = [None] * capacity
+        self.stored_at = [0.0] * capacity
+        self.last_used = [0] * capacity
+        if np is not None:
+            self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        else:
+            self.vectors = [None] * capacity
+    
+    def similarities(self, vector):
+        if np is not None:
+            return (self.vectors[:self.size] @ vector).tolist()
+        return [sum(a * b for a, b in zip(row, vector)) for row in self.vectors[:self.size]]
+    
+    def victim(self, now: float, ttl: float) -> int:
+        """优先复用已过期的槽位，否则淘汰最久未使用的条目"""
+        if self.size < self.capacity:
+            self.size += 1
+            return self.size - 1
+        for slot, stored_at in enumerate(self.stored_at):
+            if now - stored_at > ttl:
+                return slot
+        return min(range(self.capacity), key=self.last_used.__getitem__)
+
+class SemanticCache:
+    """
+    按分区（知识库 + 检索参数）保存最近查询的单位向量与结果
+    
+    查找时取余弦相似度最高且未过期的条目，达到 threshold 才视为命中；
+    查找与写入都传入 terms 时，只有词元集合相同的条目可以命中。
+    每个分区最多 max_entries 条，分区数超过 max_partitions 时淘汰最久未使用的分区。
+    """
+    
+    def __init__(self, dim: int, max_entries: int, ttl: float, threshold: float,
+                 max_partitions: int = SEMANTIC_CACHE_MAX_PARTITIONS):
+        self.dim = dim
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.threshold = threshold
+        self.max_partitions = max(1, max_partitions)
+        self._partitions = OrderedDict()
+        self._tick = 0
+        self._lock = threading.Lock()
+    
+    def _normalize(self, vector: Sequence[float]):
+        if len(vector) != self.dim:
+            raise ValueError(f"Embedding dimension mismatch: {len(vector)} (expected: {self.dim})")
+        norm = math.sqrt(sum(x * x for x in vector))
+        if norm == 0:
+            return None
+        if np is not None:
+            return np.asarray(vector, dtype=np.float32) / norm
+        return [x / norm for x in vector]
+    
+    def lookup(self, partition_key: str, vector: Sequence[float],
+               terms: Optional[frozenset] = None) -> Optional[Tuple[Dict[str, Any], float]]:
+        """返回 (缓存结果, 相似度)，未命中返回 None"""
+        unit = self._normalize(vector)
+        if unit is None:
+            return None
+        with self._lock:
+            partition = self._partitions.get(partition_key)
+            if partition is None:
+                return None
+            self._partitions.move_to_end(partition_key)
+            
+            now = time.monotonic()
+            best_slot, best_similarity = None, self.threshold
+            for slot, similarity in enumerate(partition.similarities(unit)):
+                if (similarity >= best_similarity and now - partition.stored_at[slot] <= self.ttl
+                        and (terms is None or partition.terms[slot] == terms)):
+                    best_slot, best_similarity = slot, similarity
+            if best_slot is None:
+                return None
+            
+            self._tick += 1
+            partition.last_used[best_slot] = self._tick
+            return partition.values[best_slot], best_similarity
+    
+    def add(self, partition_key: str, vector: Sequence[float], value: Dict[str, Any],
+            terms: Optional[frozenset] = None):
+        unit = self._normalize(vector)
+        if unit is None:
+            return
+        with self._lock:
+            partition = self._partitions.get(partition_key)
+            if partition is None:
+                partition = self._partitions[partition_key] = _SemanticPartition(self.dim, self.max_entries)
+                while len(self._partitions) > self.max_partitions:
+                    self._partitions.popitem(last=False)
+            self._partitions.move_to_end(partition_key)
+            
+            now = time.monotonic()
+            slot = partition.victim(now, self.ttl)
+            self._tick += 1
+            partition.vectors[slot] = unit
+            partition.values[slot] = value
+            partition.terms[slot] = terms
+            partition.stored_at[slot] = now
+            partition.last_used[slot] = self._tick
+    
+    def clear(self):
+        with self._lock:
+            self._partitions.clear()
+
+_query_cache = TTLCache(QUERY_CACHE_TTL, QUERY_CACHE_MAX_ENTRIES)
+_query_cache_backend = SQLiteCacheBackend(QUERY_CACHE_PATH) if QUERY_CACHE_BACKEND == 'sqlite' else None
+_query_cache_stats = {'hits': 0, 'misses': 0, 'semantic_hits': 0, 'coalesced': 0}
+_query_cache_stats_lock = threading.Lock()
+_semantic_cache = SemanticCache(
+    SEMANTIC_CACHE_DIM, SEMANTIC_CACHE_MAX_ENTRIES, QUERY_CACHE_TTL, SEMANTIC_CACHE_THRESHOLD
+)
+_semantic_embedder = hashing_embed
+_semantic_match_terms = True
+_single_flight = SingleFlight()
+
+def set_query_cache_backend(backend):
+    """替换外部查询缓存后端，传入 None 表示仅使用进程内缓存"""
+    global _query_cache_backend
+    _query_cache_backend = backend
+
+def set_semantic_embedder(embedder, dim: Optional[int] = None, match_terms: Optional[bool] = None):
+    """
+    替换语义缓存的查询向量化函数 embedder(text) -> 浮点数序列
+    
+    维度与当前不同时需传入 dim，会重建（清空）语义缓存。match_terms 控制是否额外要求
+    去掉停用词后的词元集合相同，默认只对内置的 hashing_embed 开启；真正的语义向量可以关闭它以命中同义改写。
+    """
+    global _semantic_embedder, _semantic_cache, _semantic_match_terms
+    _semantic_embedder = embedder
+    _semantic_match_terms = embedder is hashing_embed if match_terms is None else match_terms
+    if dim is not None and dim != _semantic_cache.dim:
+        _semantic_cache = SemanticCache(
+            dim, SEMANTIC_CACHE_MAX_ENTRIES, QUERY_CACHE_TTL, SEMANTIC_CACHE_THRESHOLD
+        )
+
+def normalize_query(query: str) -> str:
+    """规范化查询文本：去除首尾空白、合并连续空白、统一小写"""
+    return ' '.join(query.split()).lower()
+
+def _query_cache_key(query: str, knowledge_base_id: str, number_of_results: int,
+                     retrieval_filter: Optional[Dict[str, Any]] = None, search_type: Optional[str] = None) -> str:
+    return json.dumps(
+        [knowledge_base_id, normalize_query(query), number_of_results, retrieval_filter, search_type],
+        ensure_ascii=False, sort_keys=True
+    )
+
+def _get_cached_query(cache_key: str) -> Optional[Dict[str, Any]]:
+    """依次查找进程内缓存与外部后端，外部命中时回填进程内缓存"""
+    hit, value, _ = _query_cache.get(cache_key)
+    if hit:
+        return value
+    
+    if _query_cache_backend is not None:
+        try:
+            value = _query_cache_backend.get(cache_key)
+        except Exception as e:
+            log('WARNING', "Query cache backend get failed", error=str(e))
+            value = None
+        if value is not None:
+            # 外部后端保存的是 JSON，恢复为 RetrievalResult
+            value = dict(value, results=[RetrievalResult.from_dict(item) for item in value.get('results', [])])
+            _query_cache.set(cache_key, value)
+            return value
+    
+    return None
+
+def _set_cached_query(cache_key: str, value: Dict[str, Any]):
+    _query_cache.set(cache_key, value)
+    if _query_cache_backend is not None:
+        try:
+            _query_cache_backend.set(cache_key, value, QUERY_CACHE_TTL)
+        except Exception as e:
+            log('WARNING', "Query cache backend set failed", error=str(e))
+
+def _record_query_cache(hit: bool, similarity: Optional[float] = None, coalesced: bool = False) -> Dict[str, Any]:
+    """
+    更新命中计数，返回附加到响应元数据中的缓存信息
+    
+    similarity 非空表示语义缓存命中；coalesced 表示未命中但复用了并发的相同检索。
+    """
+    with _query_cache_stats_lock:
+        _query_cache_stats['hits' if hit else 'misses'] += 1
+        if similarity is not None:
+            _query_cache_stats['semantic_hits'] += 1
+        if coalesced:
+            _query_cache_stats['coalesced'] += 1
+        info = {
+            'hit': hit,
+            'hits': _query_cache_stats['hits'],
+            'misses': _query_cache_stats['misses'],
+            'semantic_hits': _query_cache_stats['semantic_hits'],
+            'coalesced_total': _query_cache_stats['coalesced']
+        }
+    if similarity is not None:
+        info['similarity'] = round(similarity, 4)
+    if coalesced:
+        info['coalesced'] = True
+    return info
+
+def _retrieve_coalesced(cache_key: str, query, knowledge_base_id, number_of_results,
+                        retrieval_filter, search_type) -> Tuple[Dict[str, Any], bool]:
+    """通过 single-flight 调用 _retrieve_knowledge_base，返回 (结果, 是否复用了并发调用的结果)"""
+    def fetch():
+        return _retrieve_knowledge_base(query, knowledge_base_id, number_of_results, retrieval_filter, search_type)
+    
+    if not SINGLE_FLIGHT_ENABLED:
+        return fetch(), False
+    
+    result, coalesced = _single_flight.do(cache_key, fetch)
+    if coalesced:
+        metrics = _current_metrics.get()
+        if metrics is not None:
+            metrics.record_coalesced()
+        # 规范化后相同的查询原文可能不同
+        result = dict(result, query=query)
+    return result, coalesced
+
+def get_single_flight_stats() -> Dict[str, int]:
+    """返回容器内累计的请求合并统计（实际发出的检索数、被合并的检索数）"""
+    return _single_flight.stats()
+
+def _embed_query(query: str) -> Optional[Sequence[float]]:
+    """向量化失败或维度与语义缓存不符时只记录日志并跳过语义缓存"""
+    try:
+        vector = _semantic_embedder(normalize_query(query))
+        if len(vector) != _semantic_cache.dim:
+            raise ValueError(f"Embedding dimension mismatch: {len(vector)} (expected: {_semantic_cache.dim})")
+        return vector
+    except Exception as e:
+        log('WARNING', "Semantic cache embedding failed", error=str(e))
+        return None
+
+def query_knowledge_base(query, knowledge_base_id, number_of_results=10, retrieval_filter=None, search_type=None):
+    """
+    查询Knowledge Base（带结果缓存）
+    
+    缓存键为 (knowledge_base_id, 规范化查询, number_of_results, 过滤条件, 检索类型)，
+    QUERY_CACHE_TTL <= 0 时关闭缓存。精确匹配未命中且启用语义缓存时，
+    在相同知识库与检索参数的分区内按查询向量相似度查找近似查询。
+    缓存未命中时相同参数的并发检索通过 single-flight 合并为一次 Bedrock 调用。
+    """
+    cache_key = _query_cache_key(query, knowledge_base_id, number_of_results, retrieval_filter, search_type)
+    if QUERY_CACHE_TTL <= 0:
+        return _retrieve_coalesced(
+            cache_key, query, knowledge_base_id, number_of_results, retrieval_filter, search_type
+        )[0]
+    
+    cached = _get_cached_query(cache_key)
+    if cached is not None:
+        return dict(cached, query=query, cache=_record_query_cache(True))
+    
+    vector = None
+    if SEMANTIC_CACHE_ENABLED:
+        partition_key = json.dumps(
+            [knowledge_base_id, number_of_results, retrieval_filter, search_type], ensure_ascii=False, sort_keys=True
+        )
+        vector = _embed_query(query)
+        terms = semantic_terms(query) if _semantic_match_terms else None
+        match = _semantic_cache.lookup(partition_key, vector, terms) if vector is not None else None
+        if match is not None:
+            value, similarity = match
+            return dict(value, query=query, cache=_record_query_cache(True, similarity))
+    
+    result, coalesced = _retrieve_coalesced(
+        cache_key, query, knowledge_base_id, number_of_results, retrieval_filter, search_type
+    )
+    if not coalesced:
+        # 被合并的调用由首个调用负责写入缓存
+        stored = {key: value for key, value in result.items() if key not in REQUEST_META_KEYS}
+        _set_cached_query(cache_key, stored)
+        if vector is not None:
+            _semantic_cache.add(partition_key, vector, stored, terms)
+    return dict(result, cache=_record_query_cache(False, coalesced=coalesced))
 
-def list_knowledge_bases():
-    """列出所有Knowledge Bases"""
+def _kb_has_inclusion_tag(kb_id: str) -> bool:
+    """检查知识库是否带有 KB_TAG_KEY=KB_TAG_VALUE 标签"""
     try:
-        response = bedrock_agent.list_knowledge_bases(maxResults=100)
-        kbs = []
+        client = get_client('bedrock-agent')
+        kb_arn = call_bedrock(
+            CONTROL_PLANE_KEY, client.get_knowledge_base, knowledgeBaseId=kb_id
+        )['knowledgeBase']['knowledgeBaseArn']
+        tags = call_bedrock(CONTROL_PLANE_KEY, client.list_tags_for_resource, resourceArn=kb_arn).get('tags', {})
+        return tags.get(KB_TAG_KEY) == KB_TAG_VALUE
+    except Exception as e:
+        log('WARNING', "Error getting tags", knowledge_base_id=kb_id, error=str(e))
+        return False
+
+def _fetch_tagged_knowledge_base_ids() -> List[str]:
+    # 只需要知识库ID：直接分页读取摘要，不为每个知识库额外调用 ListDataSources
+    with span('list_knowledge_bases'):
+        kb_ids = [
+            summary['knowledgeBaseId']
+            for summary in _paginate(
+                get_client('bedrock-agent').list_knowledge_bases, 'knowledgeBaseSummaries', maxResults=KB_PAGE_SIZE
+            )
+        ]
+    if not kb_ids:
+        return []
+    flags = map_concurrently(_kb_has_inclusion_tag, kb_ids, KB_LIST_MAX_WORKERS)
+    return [kb_id for kb_id, tagged in zip(kb_ids, flags) if tagged]
+
+def list_tagged_knowledge_base_ids() -> List[str]:
+    """列出带有 KB_TAG_KEY=KB_TAG_VALUE 标签的知识库ID（优先使用目录快照的标签索引，否则与知识库列表共用缓存）"""
+    catalog = get_kb_catalog()
+    if catalog is not None:
+        return catalog.tagged(KB_TAG_KEY, KB_TAG_VALUE)
+    return _cached_kb_list(('tagged_kb_ids', KB_TAG_KEY, KB_TAG_VALUE), _fetch_tagged_knowledge_base_ids)
+
+def query_knowledge_bases(query, knowledge_base_ids: List[str], number_of_results=10,
+                          retrieval_filter=None, search_type=None):
+    """
+    并发查询多个Knowledge Base，按相关度做 k 路归并取全局 top-k
+    
+    单个知识库失败不影响其它知识库，错误记录在 errors 中；全部失败时抛出异常。
+    """
+    knowledge_base_ids = _unique_kb_ids(knowledge_base_ids)
+    query_one = functools.partial(_query_one, query, number_of_results, retrieval_filter, search_type)
+    outcomes = map_concurrently(query_one, knowledge_base_ids, QUERY_MAX_WORKERS)
+    return _merge_kb_results(query, knowledge_base_ids, outcomes, number_of_results)
+
+async def query_knowledge_bases_async(query, knowledge_base_ids: List[str], number_of_results=10,
+                                      retrieval_filter=None, search_type=None):
+    """query_knowledge_bases 的协程版本，各知识库的检索卸载到共享线程池"""
+    knowledge_base_ids = _unique_kb_ids(knowledge_base_ids)
+    query_one = functools.partial(_query_one, query, number_of_results, retrieval_filter, search_type)
+    outcomes = await gather_limited(lambda kb_id: to_thread(query_one, kb_id), knowledge_base_ids, QUERY_MAX_WORKERS)
+    return _merge_kb_results(query, knowledge_base_ids, outcomes, number_of_results)
+
+def _unique_kb_ids(knowledge_base_ids: List[str]) -> List[str]:
+    # 去重并保持顺序
+    knowledge_base_ids = list(dict.fromkeys(knowledge_base_ids))
+    if not knowledge_base_ids:
+        raise ValueError("No knowledge bases to query")
+    return knowledge_base_ids
+
+def _query_one(query, number_of_results, retrieval_filter, search_type, kb_id):
+    """查询单个知识库，返回 (结果, 错误信息)"""
+    try:
+        return query_knowledge_base(query, kb_id, number_of_results, retrieval_filter, search_type), None
+    except Exception as e:
+        return None, str(e)
+
+def _score_key(item: RetrievalResult) -> float:
+    return item.score
+
+def _merge_kb_results(query, knowledge_base_ids: List[str], outcomes, number_of_results) -> Dict[str, Any]:
+    ranked_lists = []
+    errors = []
+    for kb_id, (kb_result, error) in zip(knowledge_base_ids, outcomes):
+        if error is not None:
+            errors.append({'knowledge_base_id': kb_id, 'error': error})
+            continue
+        # Bedrock 返回的结果已按相关度降序排列，这里显式排序以保证归并前提成立
+        ranked_lists.append(sorted(
+            (item.replace(knowledge_base_id=kb_id) for item in kb_result['results']),
+            key=_score_key,
+            reverse=True
+        ))
+    
+    if errors and not ranked_lists:
+        raise Exception(f"Failed to query knowledge bases: {errors}")
+    
+    merged = heapq.merge(*ranked_lists, key=_score_key, reverse=True)
+    results = list(itertools.islice(merged, number_of_results))
+    
+    result = {
+        'query': query,
+        'knowledge_base_id': ', '.join(knowledge_base_ids),
+        'knowledge_base_ids': knowledge_base_ids,
+        'results': results,
+        'count': len(results)
+    }
+    if errors:
+        result['errors'] = errors
+    return result
+
+_hedge_latencies = deque(maxlen=HEDGE_SAMPLE_SIZE)
+_hedge_stats = {'requests': 0, 'hedges': 0, 'wins': 0}
+_hedge_lock = threading.Lock()
+_hedge_executor: Optional[ThreadPoolExecutor] = None
+
+def _hedge_delay() -> float:
+    """根据最近的检索延迟计算对冲等待时间（秒），样本不足时使用默认值"""
+    with _hedge_lock:
+        samples = sorted(_hedge_latencies)
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        delay_ms = HEDGE_DEFAULT_DELAY_MS
+    else:
+        delay_ms = samples[min(len(samples) - 1, int(len(samples) * HEDGE_PERCENTILE))] * 1000
+    return max(HEDGE_MIN_DELAY_MS, delay_ms) / 1000
+
+def _hedge_pool_size() -> int:
+    """
+    对冲线程池大小：批量查询 × 多知识库扇出（或 asyncio 引擎的线程池）同时在途的检索数，
+    再为同样数量的对冲请求留出空间，避免主请求在池中排队
+    """
+    return 2 * max(QUERY_MAX_WORKERS * BATCH_MAX_CONCURRENCY, ASYNC_MAX_WORKERS)
+
+def _timed(fn, started: Optional[threading.Event] = None):
+    """执行 fn 并记录耗时样本；started 在 fn 真正开始执行时置位"""
+    if started is not None:
+        started.set()
+    start = time.monotonic()
+    result = fn()
+    with _hedge_lock:
+        _hedge_latencies.append(time.monotonic() - start)
+    return result
+
+def _try_acquire_hedge() -> bool:
+    """对冲次数不超过请求数的 HEDGE_MAX_RATE，防止放大后端负载"""
+    with _hedge_lock:
+        if _hedge_stats['hedges'] + 1 > _hedge_stats['requests'] * HEDGE_MAX_RATE:
+            return False
+        _hedge_stats['hedges'] += 1
+        return True
+
+def hedged_call(fn) -> Tuple[Any, Dict[str, Any]]:
+    """
+    对冲请求：首个请求在百分位延迟内未返回时再发一个相同请求，先成功者胜出
+    
+    返回 (结果, 对冲信息)；未启用对冲时直接调用 fn。
+    """
+    global _hedge_executor
+    if not HEDGE_ENABLED:
+        return fn(), {'hedged': False}
+    
+    with _hedge_lock:
+        _hedge_stats['requests'] += 1
+        if _hedge_executor is None:
+            _hedge_executor = ThreadPoolExecutor(max_workers=_hedge_pool_size())
+    
+    # 对冲等待从主请求开始执行时计时，线程池排队的时间不触发对冲
+    started = threading.Event()
+    fn = bind_context(fn)
+    primary = _hedge_executor.submit(_timed, fn, started)
+    started.wait()
+    done, _ = wait([primary], timeout=_hedge_delay())
+    if done or not _try_acquire_hedge():
+        return primary.result(), {'hedged': False}
+    
+    hedge = _hedge_executor.submit(_timed, fn)
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.record_hedge()
+    pending = {primary, hedge}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is not None:
+                error = future.exception()
+                continue
+            won = future is hedge
+            with _hedge_lock:
+                if won:
+                    _hedge_stats['wins'] += 1
+                stats = dict(_hedge_stats)
+            if won and metrics is not None:
+                metrics.record_hedge_win()
+            return future.result(), {'hedged': True, 'won': won, 'hedges': stats['hedges'], 'wins': stats['wins']}
+    raise error
+
+def get_hedge_stats() -> Dict[str, int]:
+    """返回容器内累计的对冲统计（请求数、对冲数、对冲胜出数）"""
+    with _hedge_lock:
+        return dict(_hedge_stats)
+
+_TOKEN_PATTERN = re.compile(r'[a-z0-9]+|[\u4e00-\u9fff]')
+
+def _tokenize(text: str) -> List[str]:
+    """英文按单词、中文按单字切分"""
+    return _TOKEN_PATTERN.findall(text.lower())
+
+def bm25_scores(query: str, documents: List[str], k1: float = 1.2, b: float = 0.75) -> List[float]:
+    """以候选集合为语料计算 BM25 分数，按最高分归一化到 [0, 1]"""
+    query_terms = set(_tokenize(query))
+    doc_terms = [_tokenize(doc) for doc in documents]
+    if not query_terms or not doc_terms:
+        return [0.0] * len(documents)
+    
+    avg_len = sum(len(terms) for terms in doc_terms) / len(doc_terms) or 1.0
+    doc_freq = {term: sum(1 for terms in doc_terms if term in terms) for term in query_terms}
+    n_docs = len(doc_terms)
+    
+    scores = []
+    for terms in doc_terms:
+        counts: Dict[str, int] = {}
+        for term in terms:
+            if term in query_terms:
+                counts[term] = counts.get(term, 0) + 1
+        score = 0.0
+        for term, tf in counts.items():
+            idf = math.log(1 + (n_docs - doc_freq[term] + 0.5) / (doc_freq[term] + 0.5))
+            score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len(terms) / avg_len))
+        scores.append(score)
+    
+    top = max(scores)
+    return [score / top for score in scores] if top > 0 else scores
+
+def bedrock_rerank_scores(query: str, documents: List[str]) -> List[float]:
+    """调用 Bedrock Rerank API（RERANK_MODEL_ARN 指定模型）"""
+    if not RERANK_MODEL_ARN:
+        raise ValueError("RERANK_MODEL_ARN is required for the bedrock reranker")
+    
+    response = call_bedrock(
+        'rerank',
+        get_client('bedrock-agent-runtime').rerank,
+        queries=[{'type': 'TEXT', 'textQuery': {'text': query}}],
+        sources=[
+            {'type': 'INLINE', 'inlineDocumentSource': {'type': 'TEXT', 'textDocument': {'text': doc}}}
+            for doc in documents
+        ],
+        rerankingConfiguration={
+            'type': 'BEDROCK_RERANKING_MODEL',
+            'bedrockRerankingConfiguration': {
+                'modelConfiguration': {'modelArn': RERANK_MODEL_ARN},
+                'numberOfResults': len(documents)
+            }
+        }
+    )
+    scores = [0.0] * len(documents)
+    for item in response.get('results', []):
+        scores[item['index']] = item['relevanceScore']
+    return scores
+
+# 重排序打分器：fn(query, documents) -> 与 documents 等长的分数列表，可通过 register_reranker 扩展
+RERANKERS = {
+    'bm25': bm25_scores,
+    'bedrock': bedrock_rerank_scores,
+}
+
+def register_reranker(name: str, scorer):
+    """注册自定义重排序打分器，通过 RERANK_SCORER=name 启用"""
+    RERANKERS[name] = scorer
+
+def rerank_results(query: str, results: List[RetrievalResult], number_of_results: int) -> List[RetrievalResult]:
+    """
+    对候选结果重排序并取 top-k
+    
+    bm25 打分与原始向量分数按 RERANK_BM25_WEIGHT 加权混合；其它打分器的分数直接作为最终分数。
+    原始向量分数保留在 vector_score 字段。
+    """
+    if not results:
+        return results
+    
+    scorer = RERANKERS.get(RERANK_SCORER)
+    if scorer is None:
+        raise ValueError(f"Unknown reranker: {RERANK_SCORER}")
+    
+    with span('rerank'):
+        scores = scorer(query, [item.content for item in results])
+    
+    reranked = []
+    for item, score in zip(results, scores):
+        if RERANK_SCORER == 'bm25':
+            score = RERANK_BM25_WEIGHT * score + (1 - RERANK_BM25_WEIGHT) * item.score
+        reranked.append(item.replace(score=score, vector_score=item.score))
+    
+    # 只需要 top-k，使用堆做部分排序
+    return heapq.nlargest(number_of_results, reranked, key=_score_key)
+
+def _shingles(text: str) -> set:
+    """按 DEDUP_SHINGLE_SIZE 个连续词元切分的 shingle 集合"""
+    tokens = _tokenize(text)
+    if len(tokens) <= DEDUP_SHINGLE_SIZE:
+        return {tuple(tokens)}
+    return {tuple(tokens[i:i + DEDUP_SHINGLE_SIZE]) for i in range(len(tokens) - DEDUP_SHINGLE_SIZE + 1)}
+
+def dedup_results(results: List[RetrievalResult], limit: Optional[int] = None) -> Tuple[List[RetrievalResult], int]:
+    """
+    折叠同一 S3 对象内的近似重复片段
+    
+    按相关度从高到低遍历，与同一 uri 下已保留片段的 shingle Jaccard 相似度
+    达到 DEDUP_THRESHOLD 的片段被丢弃，后续候选自动补位。
+    候选数不超过 100，直接两两比较精确 Jaccard，无需 MinHash 近似。
+    
+    Returns:
+        (保留的结果, 被丢弃的数量)
+    """
+    kept: List[RetrievalResult] = []
+    kept_shingles: Dict[str, List[set]] = {}
+    dropped = 0
+    
+    for item in sorted(results, key=_score_key, reverse=True):
+        if limit is not None and len(kept) >= limit:
+            break
         
-        for kb in response.get('knowledgeBaseSummaries', []):
-            kb_id = kb['knowledgeBaseId']
-            
-            # 获取数据源
-            try:
-                ds_response = bedrock_agent.list_data_sources(
-                    knowledgeBaseId=kb_id,
-                    maxResults=10
-                )
-                
-                data_sources = [
-                    {
-                        'id': ds['dataSourceId'],
-                        'name': ds['name'],
-                        'status': ds['status']
-                    }
-                    for ds in ds_response.get('dataSourceSummaries', [])
-                ]
-            except Exception as e:
-                print(f"Error getting data sources for KB {kb_id}: {e}")
-                data_sources = []
-            
-            kbs.append({
-                'id': kb_id,
-                'name': kb['name'],
-                'description': kb.get('description', ''),
-                'data_sources': data_sources
-            })
+        uri = item.location.get('s3Location', {}).get('uri')
+        if uri is None:
+            kept.append(item)
+            continue
         
-        return {'knowledge_bases': kbs}
+        shingles = _shingles(item.content)
+        group = kept_shingles.setdefault(uri, [])
+        if any(len(shingles & other) / len(shingles | other) >= DEDUP_THRESHOLD for other in group):
+            dropped += 1
+            continue
+        
+        group.append(shingles)
+        kept.append(item)
     
-    except Exception as e:
-        raise Exception(f"Failed to list knowledge bases: {str(e)}")
+    return kept, dropped
 
-def query_knowledge_base(query, knowledge_base_id, number_of_results=10):
-    """查询Knowledge Base"""
+def _retrieve_knowledge_base(query, knowledge_base_id, number_of_results=10, retrieval_filter=None, search_type=None):
+    """
+    调用 Bedrock Retrieve API 查询Knowledge Base
+    
+    启用去重或重排序时超量召回候选，先折叠近似重复，再重排序并截取 top-k。
+    元数据过滤与检索类型在索引侧生效，不在代理内过滤。
+    """
+    overfetch = max(
+        RERANK_OVERFETCH if RERANKING_ENABLED else 1,
+        DEDUP_OVERFETCH if DEDUP_ENABLED else 1
+    )
+    fetch_count = min(MAX_RETRIEVE_RESULTS, max(number_of_results, number_of_results * overfetch))
+    vector_search_config = {'numberOfResults': fetch_count}
+    if retrieval_filter:
+        vector_search_config['filter'] = retrieval_filter
+    if search_type:
+        vector_search_config['overrideSearchType'] = search_type
+    
     try:
-        response = bedrock_agent_runtime.retrieve(
-            knowledgeBaseId=knowledge_base_id,
-            retrievalQuery={'text': query},
-            retrievalConfiguration={
-                'vectorSearchConfiguration': {
-                    'numberOfResults': number_of_results
-                }
-            }
-        )
+        with span('retrieve'):
+            response, hedge = hedged_call(lambda: call_bedrock(
+                knowledge_base_id,
+                get_client('bedrock-agent-runtime').retrieve,
+                knowledgeBaseId=knowledge_base_id,
+                retrievalQuery={'text': query},
+                retrievalConfiguration={'vectorSearchConfiguration': vector_search_config}
+            ))
         
-        results = []
-        for item in response.get('retrievalResults', []):
-            results.append({
-                'content': item['content']['text'],
-                'score': item.get('score', 0),
-                'location': item.get('location', {}),
-                'metadata': item.get('metadata', {})
-            })
+        # 直接调用构造函数，每条结果少一层方法调用
+        results = [
+            RetrievalResult(item['content']['text'], item.get('score', 0),
+                            item.get('location', {}), item.get('metadata', {}))
+            for item in response.get('retrievalResults', [])
+        ]
         
-        return {
+        duplicates_removed = 0
+        if DEDUP_ENABLED:
+            with span('dedup'):
+                # 之后还要重排序时保留全部去重后的候选
+                results, duplicates_removed = dedup_results(
+                    results, None if RERANKING_ENABLED else number_of_results
+                )
+        
+        if RERANKING_ENABLED:
+            results = rerank_results(query, results, number_of_results)
+        else:
+            results = results[:number_of_results]
+        
+        result = {
             'query': query,
             'knowledge_base_id': knowledge_base_id,
             'results': results,
             'count': len(results)
         }
+        if duplicates_removed:
+            result['duplicates_removed'] = duplicates_removed
+        if hedge['hedged']:
+            result['hedge'] = hedge
+        return result
     
     except Exception as e:
         raise Exception(f"Failed to query knowledge base: {str(e)}")
 
+def validate_retrieval_filter(retrieval_filter: Any, depth: int = 0) -> Dict[str, Any]:
+    """
+    校验 Retrieve 元数据过滤表达式（RetrievalFilter 结构）
+    
+    每个节点只能有一个操作符：比较操作符的值为 {"key": ..., "value": ...}，
+    andAll / orAll 的值为至少两个子过滤条件的数组。
+    """
+    if depth > FILTER_MAX_DEPTH:
+        raise ValueError(f"filter is nested too deeply (max depth: {FILTER_MAX_DEPTH})")
+    if not isinstance(retrieval_filter, dict) or len(retrieval_filter) != 1:
+        raise ValueError("filter must be an object with exactly one operator")
+    
+    operator, operand = next(iter(retrieval_filter.items()))
+    if operator in FILTER_GROUP_OPERATORS:
+        if not isinstance(operand, list) or len(operand) < 2:
+            raise ValueError(f"filter.{operator} must be an array of at least 2 filters")
+        for child in operand:
+            validate_retrieval_filter(child, depth + 1)
+    elif operator in FILTER_LEAF_OPERATORS:
+        if not isinstance(operand, dict) or set(operand) != {'key', 'value'}:
+            raise ValueError(f"filter.{operator} must be an object with 'key' and 'value'")
+        if not isinstance(operand['key'], str) or not operand['key']:
+            raise ValueError(f"filter.{operator}.key must be a non-empty string")
+        if operator in ('in', 'notIn') and not isinstance(operand['value'], list):
+            raise ValueError(f"filter.{operator}.value must be an array")
+    else:
+        raise ValueError(
+            f"Invalid filter operator: {operator} "
+            f"(expected one of: {', '.join(FILTER_LEAF_OPERATORS + FILTER_GROUP_OPERATORS)})"
+        )
+    return retrieval_filter
+
+def _search_options(params: Dict[str, Any]) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """读取并校验 filter / search_type 参数"""
+    retrieval_filter = params.get('filter')
+    if retrieval_filter is not None:
+        if isinstance(retrieval_filter, str):
+            try:
+                retrieval_filter = json.loads(retrieval_filter)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"filter is not valid JSON: {e}")
+        retrieval_filter = validate_retrieval_filter(retrieval_filter)
+    
+    search_type = params.get('search_type')
+    if search_type is not None:
+        search_type = str(search_type).upper()
+        if search_type not in SEARCH_TYPES:
+            raise ValueError(f"Invalid search_type: {search_type} (expected one of: {', '.join(SEARCH_TYPES)})")
+    return retrieval_filter, search_type
+
+def _number_of_results(params: Dict[str, Any]) -> int:
+    """读取并校验 number_of_results：接受整数或整数字符串，取值范围 1..MAX_RETRIEVE_RESULTS"""
+    value = params.get('number_of_results', 10)
+    if isinstance(value, str) and value.strip().lstrip('+-').isdigit():
+        number_of_results = int(value)
+    elif isinstance(value, int) and not isinstance(value, bool):
+        number_of_results = value
+    else:
+        raise ValueError(f"number_of_results must be an integer, got {value!r}")
+    if not 1 <= number_of_results <= MAX_RETRIEVE_RESULTS:
+        raise ValueError(f"number_of_results must be between 1 and {MAX_RETRIEVE_RESULTS}, got {number_of_results}")
+    return number_of_results
+
+def _resolve_query(params: Dict[str, Any]) -> Tuple[List[str], str, Tuple[Any, ...]]:
+    """
+    解析查询参数，返回 (多知识库ID列表, 单知识库ID, (number_of_results, filter, search_type))
+    
+    多知识库ID列表为空时查询单知识库。
+    """
+    query = params.get('query')
+    if query is None or query == '':
+        raise ValueError("Missing required parameter: query")
+    if not isinstance(query, str):
+        raise ValueError(f"query must be a string, got {type(query).__name__}")
+    if not query.strip():
+        raise ValueError("query must not be blank")
+    number_of_results = _number_of_results(params)
+    retrieval_filter, search_type = _search_options(params)
+    
+    kb_ids = params.get('knowledge_base_ids') or []
+    if isinstance(kb_ids, str):
+        kb_ids = [kb_id.strip() for kb_id in kb_ids.split(',') if kb_id.strip()]
+    kb_ids = [resolve_knowledge_base_id(kb_id) for kb_id in kb_ids]
+    if params.get('use_tagged_kbs'):
+        kb_ids = kb_ids + list_tagged_knowledge_base_ids()
+        if not kb_ids:
+            raise ValueError(f"No knowledge bases tagged with {KB_TAG_KEY}={KB_TAG_VALUE}")
+    
+    kb_id = resolve_knowledge_base_id(params.get('knowledge_base_id') or DEFAULT_KB_ID)
+    return kb_ids, kb_id, (number_of_results, retrieval_filter, search_type)
+
+def run_query(params: Dict[str, Any]) -> Dict[str, Any]:
+    """根据工具参数选择单知识库、多知识库或标签知识库查询"""
+    kb_ids, kb_id, options = _resolve_query(params)
+    if kb_ids:
+        return query_knowledge_bases(params['query'], kb_ids, *options)
+    return query_knowledge_base(params['query'], kb_id, *options)
+
+async def run_query_async(params: Dict[str, Any]) -> Dict[str, Any]:
+    """run_query 的协程版本"""
+    kb_ids, kb_id, options = await to_thread(_resolve_query, params)
+    if kb_ids:
+        return await query_knowledge_bases_async(params['query'], kb_ids, *options)
+    return await to_thread(query_knowledge_base, params['query'], kb_id, *options)
+
+def batch_query_knowledge_bases(event: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    在一次调用内并发执行多个查询
+    
+    queries 中每一项可以是查询字符串，也可以是与 QueryKnowledgeBases 参数相同的对象；
+    未指定的参数沿用顶层的 knowledge_base_id / knowledge_base_ids / use_tagged_kbs / number_of_results /
+    filter / search_type。
+    单个查询失败只影响该项结果。asyncio 引擎下整个批次（包括多知识库查询）在同一事件循环内编排。
+    """
+    if async_engine_enabled():
+        return run_async(batch_query_knowledge_bases_async(event))
+    
+    queries, defaults, max_concurrency = _batch_plan(event)
+    
+    def run_one(item):
+        params = _batch_params(defaults, item)
+        try:
+            return {'status': 'success', 'result': run_query(params)}
+        except Exception as e:
+            return {'status': 'error', 'query': params.get('query', ''), 'error': str(e)}
+    
+    with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(queries)))) as executor:
+        return _batch_summary(list(executor.map(bind_context(run_one), queries)))
+
+async def batch_query_knowledge_bases_async(event: Dict[str, Any]) -> Dict[str, Any]:
+    """batch_query_knowledge_bases 的协程版本"""
+    queries, defaults, max_concurrency = _batch_plan(event)
+    
+    async def run_one(item):
+        params = _batch_params(defaults, item)
+        try:
+            return {'status': 'success', 'result': await run_query_async(params)}
+        except Exception as e:
+            return {'status': 'error', 'query': params.get('query', ''), 'error': str(e)}
+    
+    return _batch_summary(await gather_limited(run_one, queries, max_concurrency))
+
+def _batch_plan(event: Dict[str, Any]) -> Tuple[list, Dict[str, Any], int]:
+    """校验批量查询参数，返回 (queries, 默认参数, 并发上限)"""
+    queries = event['queries']
+    if not isinstance(queries, list) or not queries:
+        raise ValueError("queries must be a non-empty array")
+    if len(queries) > BATCH_MAX_QUERIES:
+        raise ValueError(f"Too many queries: {len(queries)} (max: {BATCH_MAX_QUERIES})")
+    
+    defaults = {
+        key: event[key]
+        for key in ('knowledge_base_id', 'knowledge_base_ids', 'use_tagged_kbs', 'number_of_results',
+                    'filter', 'search_type')
+        if key in event
+    }
+    
+    max_concurrency = min(int(event.get('max_concurrency') or BATCH_MAX_CONCURRENCY), BATCH_MAX_CONCURRENCY)
+    return queries, defaults, max_concurrency
+
+def _batch_params(defaults: Dict[str, Any], item) -> Dict[str, Any]:
+    return dict(defaults, **(item if isinstance(item, dict) else {'query': item}))
+
+def _batch_summary(items: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return {
+        'items': items,
+        'count': len(items),
+        'failed': sum(1 for item in items if item['status'] == 'error')
+    }
+
+def _response_budget(event: Dict[str, Any]) -> Tuple[Optional[int], Optional[int]]:
+    """
+    从工具参数（或环境变量默认值）读取 (文本预算, max_chunk_chars)，0 表示不限制
+    
+    max_response_bytes 限制的是整个响应体；扣除 JSON 外壳预留后的部分作为响应文本的预算，
+    文本按转义后的长度计入（见 _escaped_len）。
+    """
+    max_bytes = int(event.get('max_response_bytes') or RESPONSE_MAX_BYTES)
+    max_chunk_chars = int(event.get('max_chunk_chars') or RESPONSE_MAX_CHUNK_CHARS)
+    if max_bytes:
+        max_bytes = max(1, max_bytes - RESPONSE_ENVELOPE_BYTES)
+    return max_bytes or None, max_chunk_chars or None
+
+def _output_options(event: Dict[str, Any]) -> Tuple[str, Tuple[str, ...]]:
+    """读取并校验 (output_format, exclude_fields)"""
+    output_format = (event.get('output_format') or 'markdown').lower()
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Invalid output_format: {output_format} (expected one of: {', '.join(OUTPUT_FORMATS)})")
+    
+    exclude_fields = event.get('exclude_fields') or ()
+    if isinstance(exclude_fields, str):
+        exclude_fields = [field.strip() for field in exclude_fields.split(',') if field.strip()]
+    return output_format, tuple(exclude_fields)
+
+def _dispatch(event: Dict[str, Any], metrics: RequestMetrics) -> Tuple[Dict[str, Any], Callable[[], Iterator[str]]]:
+    """
+    根据工具名称或参数执行对应功能
+    
+    返回 (结果, render)，render() 返回按输出顺序逐块产生的响应文本。
+    """
+    tool_name = event.get('tool_name', '')
+    output_format, exclude_fields = _output_options(event)
+    
+    # 根据工具名称或参数判断调用哪个功能
+    if tool_name == 'ListKnowledgeBases' or (not tool_name and 'query' not in event and 'queries' not in event):
+        # ListKnowledgeBases
+        metrics.tool = 'ListKnowledgeBases'
+        max_results = event.get('max_results')
+        if max_results is not None:
+            max_results = int(max_results)
+            if max_results < 1:
+                raise ValueError("max_results must be a positive integer")
+        
+        result = list_knowledge_bases(max_results, event.get('next_token') or None)
+        if output_format == 'markdown':
+            render = lambda: iter([format_list_results(result)])
+        else:
+            render = lambda: iter_structured(result, output_format)
+        
+    elif tool_name == 'BatchQueryKnowledgeBases' or (not tool_name and 'queries' in event):
+        # BatchQueryKnowledgeBases
+        metrics.tool = 'BatchQueryKnowledgeBases'
+        if 'queries' not in event:
+            raise ValueError("Missing required parameter: queries")
+        
+        result = batch_query_knowledge_bases(event)
+        if output_format == 'markdown':
+            render = lambda: iter_batch_results(result, *_response_budget(event))
+        else:
+            render = lambda: iter_structured(
+                project_batch_result(result, output_format, exclude_fields, *_response_budget(event)),
+                output_format
+            )
+        
+    elif tool_name == 'QueryKnowledgeBases' or 'query' in event:
+        # QueryKnowledgeBases
+        metrics.tool = 'QueryKnowledgeBases'
+        if 'query' not in event:
+            raise ValueError("Missing required parameter: query")
+        
+        result = run_query(event)
+        if output_format == 'markdown':
+            render = lambda: iter_query_results(result, 1, *_response_budget(event))
+        else:
+            render = lambda: iter_structured(
+                project_query_result(result, output_format, exclude_fields, *_response_budget(event)),
+                output_format
+            )
+        
+    else:
+        raise ValueError(f"Unknown tool or invalid parameters. Tool: {tool_name}, Event: {event}")
+    
+    return result, render
+
+def _error_body(error_msg: str) -> str:
+    return json.dumps({
+        'content': [
+            {
+                'type': 'text',
+                'text': f'错误: {error_msg}'
+            }
+        ]
+    })
+
+def _escape_ascii(chunk: str) -> str:
+    """标准库 C 实现的字符串转义（与 json.dumps 默认的 ensure_ascii=True 一致），去掉两端引号"""
+    return json.encoder.encode_basestring_ascii(chunk)[1:-1]
+
+def serialize_body(chunks: Iterator[str], meta: Optional[Dict[str, Any]] = None) -> str:
+    """
+    单遍生成 MCP 响应体 JSON：格式化分块合并成批后转义并直接拼接，不构造完整的中间文本与 body 字典
+    
+    转义结果只含 ASCII，即使原文含中文，拼接结果每个字符也只占一个字节。
+    """
+    return ''.join(iter_response_body(_batch_chunks(chunks, STREAM_CHUNK_BYTES), meta))
+
+def _batch_chunks(chunks: Iterator[str], min_chars: int) -> Iterator[str]:
+    """把小分块合并到约 min_chars 个字符再转义，减少逐块调用的开销，中间文本仍保持较小"""
+    batch = []
+    size = 0
+    for chunk in chunks:
+        batch.append(chunk)
+        size += len(chunk)
+        if size >= min_chars:
+            yield ''.join(batch)
+            batch = []
+            size = 0
+    if batch:
+        yield ''.join(batch)
+
+def iter_response_body(chunks: Iterator[str], meta: Optional[Dict[str, Any]] = None) -> Iterator[str]:
+    """
+    逐块生成 MCP 响应体 JSON，拼接结果与 json.dumps({'content': [...], '_meta': meta}) 完全一致
+    
+    JSON 字符串转义按字符进行，因此可以对每个分块单独转义后直接拼接。
+    转义固定使用标准库：orjson 需要先编码成 bytes 再解码，中间副本反而抬高内存峰值。
+    转义耗时逐批累计，结束时计入 serialize 阶段。
+    """
+    metrics = _current_metrics.get()
+    seconds = 0.0
+    try:
+        yield '{"content": [{"type": "text", "text": "'
+        for chunk in chunks:
+            start = time.perf_counter()
+            escaped = _escape_ascii(chunk)
+            seconds += time.perf_counter() - start
+            yield escaped
+        yield '"}]'
+        if meta:
+            yield ', "_meta": ' + json.dumps(meta)
+        yield '}'
+    finally:
+        if metrics is not None:
+            metrics.add_span('serialize', seconds)
+
+def _coalesce(pieces: Iterator[str], min_bytes: int) -> Iterator[bytes]:
+    """首个分块立即输出以降低首字节时间，之后累积到 min_bytes 再输出"""
+    buffer = []
+    buffered = 0
+    first = True
+    for piece in pieces:
+        data = piece.encode('utf-8')
+        if first:
+            first = False
+            yield data
+            continue
+        buffer.append(data)
+        buffered += len(data)
+        if buffered >= min_bytes:
+            yield b''.join(buffer)
+            buffer.clear()
+            buffered = 0
+    if buffer:
+        yield b''.join(buffer)
+
+def is_warmup_event(event: Dict[str, Any]) -> bool:
+    """warmup 事件：显式的 {"warmup": true}，或 EventBridge 定时规则的默认事件"""
+    return bool(event.get(WARMUP_EVENT_KEY)) or (
+        event.get('source') == 'aws.events' and event.get('detail-type') == 'Scheduled Event'
+    )
+
+def warm_up() -> Dict[str, Any]:
+    """
+    预热当前容器：创建 boto3 clients、预先建立连接、加载目录快照，不调用任何 Bedrock API
+    
+    之后的第一次真实请求直接复用这些资源。可重复调用，只补足缺少的部分。
+    """
+    connections = {}
+    for service_name in WARMUP_SERVICES:
+        with span('client'):
+            client = get_client(service_name)
+        with span('connect'):
+            try:
+                connections[service_name] = _prime_connections(client, WARMUP_CONNECTIONS)
+            except Exception as e:
+                connections[service_name] = 0
+                log('WARNING', "Connection warmup failed", service=service_name, error=str(e))
+    
+    if async_engine_enabled():
+        run_async(asyncio.sleep(0))
+    
+    with span('catalog'):
+        catalog = get_kb_catalog()
+    
+    return {
+        'clients': sorted(_clients),
+        'connections': connections,
+        'kb_catalog': len(catalog.knowledge_bases) if catalog is not None else None,
+    }
+
+def _handle_warmup(request_id: Optional[str]) -> Dict[str, Any]:
+    """处理 warmup 事件；指标以 tool=Warmup 输出，不混入工具调用的延迟统计"""
+    global _cold_start
+    
+    metrics = RequestMetrics(cold_start=_cold_start)
+    metrics.tool = 'Warmup'
+    metrics_token = _current_metrics.set(metrics)
+    _cold_start = False
+    
+    try:
+        status = warm_up()
+        log('INFO', "Warmup completed", request_id=request_id, cold_start=metrics.cold_start, **status)
+        return {
+            'statusCode': 200,
+            'body': json.dumps({'warmup': dict(status, cold_start=metrics.cold_start)})
+        }
+    except Exception as e:
+        metrics.error = True
+        log('ERROR', "Warmup failed", request_id=request_id, error=str(e), traceback=traceback.format_exc())
+        return {
+            'statusCode': 500,
+            'body': _error_body(str(e))
+        }
+    finally:
+        _current_metrics.reset(metrics_token)
+        metrics.emit(request_id)
+
+def stream_handler(event: Dict[str, Any], context: Any) -> Iterator[bytes]:
+    """
+    流式 handler：生成器，按块产出 UTF-8 编码的响应体（与 lambda_handler 的 body 内容相同）
+    
+    检索完成后立即输出标题，之后每格式化一条结果就输出一块，内存占用与单块大小相关，
+    不随 number_of_results 增长。供支持响应流的宿主（如 Lambda Web Adapter、自定义运行时）调用；
+    开始输出后发生的错误只能记录日志并中止响应。
+    """
+    global _cold_start
+    
+    if is_warmup_event(event):
+        yield _handle_warmup(getattr(context, 'aws_request_id', None))['body'].encode('utf-8')
+        return
+    
+    sampled = should_sample()
+    request_id = getattr(context, 'aws_request_id', None)
+    tool_name = event.get('tool_name', '')
+    metrics = RequestMetrics(cold_start=_cold_start)
+    _current_metrics.set(metrics)
+    _cold_start = False
+    profiler = start_profiler(event.get('_profile') or PROFILE_MODE)
+    
+    try:
+        log_payload('DEBUG', "Received event", event, sampled, request_id=request_id)
+        try:
+            result, render = _dispatch(event, metrics)
+        except Exception as e:
+            metrics.error = True
+            log('ERROR', "Request failed", request_id=request_id, tool_name=tool_name,
+                error=str(e), traceback=traceback.format_exc())
+            body = _error_body(str(e)).encode('utf-8')
+            metrics.first_byte_at = time.perf_counter()
+            metrics.response_bytes = len(body)
+            yield body
+            return
+        
+        metrics.result_count = result.get('count') or 0
+        metrics.cache_hit = bool(result.get('cache', {}).get('hit'))
+        meta = {key: result[key] for key in REQUEST_META_KEYS if key in result}
+        try:
+            for chunk in _coalesce(iter_response_body(render(), meta), STREAM_CHUNK_BYTES):
+                if metrics.first_byte_at is None:
+                    metrics.first_byte_at = time.perf_counter()
+                metrics.response_bytes += len(chunk)
+                yield chunk
+        except Exception as e:
+            metrics.error = True
+            log('ERROR', "Streaming response aborted", request_id=request_id, tool_name=tool_name,
+                error=str(e), traceback=traceback.format_exc())
+            return
+        
+        log('INFO', "Request completed", request_id=request_id, tool_name=tool_name, count=result.get('count'))
+    
+    finally:
+        # 生成器可能在其它上下文中被关闭，token 无法 reset，直接清空
+        _current_metrics.set(None)
+        stop_profiler(profiler, request_id)
+        metrics.emit(request_id)
+
 def lambda_handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
     Lambda handler - 支持多种调用方式
     1. Gateway 直接传递工具参数
     2. 显式指定 tool_name
+    3. warmup 事件（定时预热器），只预热容器不执行查询
     """
+    global _cold_start
+    
+    if is_warmup_event(event):
+        return _handle_warmup(getattr(context, 'aws_request_id', None))
+    
+    sampled = should_sample()
+    request_id = getattr(context, 'aws_request_id', None)
+    tool_name = ''
+    metrics = RequestMetrics(cold_start=_cold_start)
+    metrics_token = _current_metrics.set(metrics)
+    _cold_start = False
+    profiler = start_profiler(event.get('_profile') or PROFILE_MODE)
+    
     try:
-        print(f"Received event: {json.dumps(event)}")
+        log_payload('DEBUG', "Received event", event, sampled, request_id=request_id)
         
         # 获取工具名称（如果提供）
         tool_name = event.get('tool_name', '')
+        result, render = _dispatch(event, metrics)
         
-        # 根据工具名称或参数判断调用哪个功能
-        if tool_name == 'ListKnowledgeBases' or (not tool_name and 'query' not in event):
-            # ListKnowledgeBases
-            result = list_knowledge_bases()
-            formatted_text = format_list_results(result)
-            
-        elif tool_name == 'QueryKnowledgeBases' or 'query' in event:
-            # QueryKnowledgeBases
-            if 'query' not in event:
-                raise ValueError("Missing required parameter: query")
-            
-            kb_id = event.get('knowledge_base_id') or DEFAULT_KB_ID
-            number_of_results = event.get('number_of_results', 10)
-            
-            result = query_knowledge_base(event['query'], kb_id, number_of_results)
-            formatted_text = format_query_results(result)
-            
-        else:
-            raise ValueError(f"Unknown tool or invalid parameters. Tool: {tool_name}, Event: {event}")
+        # 返回 MCP 标准格式，格式化与序列化单遍完成：
+        # 转义耗时由 iter_response_body 计入 serialize，其余计入 format
+        meta = {key: result[key] for key in REQUEST_META_KEYS if key in result}
+        format_started = time.perf_counter()
+        body_json = serialize_body(render(), meta)
+        metrics.add_span('format', time.perf_counter() - format_started - metrics.spans.get('serialize', 0.0))
+        
+        log_payload('DEBUG', "Result", result, sampled, request_id=request_id)
+        log('INFO', "Request completed", request_id=request_id, tool_name=tool_name, count=result.get('count'))
         
-        print(f"Result: {json.dumps(result, default=str)}")
+        metrics.result_count = result.get('count') or 0
+        metrics.response_bytes = _utf8_len(body_json)
+        metrics.cache_hit = bool(result.get('cache', {}).get('hit'))
         
-        # 返回 MCP 标准格式
         return {
             'statusCode': 200,
-            'body': json.dumps({
-                'content': [
-                    {
-                        'type': 'text',
-                        'text': formatted_text
-                    }
-                ]
-            })
+            'body': body_json
         }
         
     except Exception as e:
         error_msg = str(e)
-        print(f"Error: {error_msg}")
-        import traceback
-        traceback.print_exc()
+        metrics.error = True
+        log('ERROR', "Request failed", request_id=request_id, tool_name=tool_name,
+            error=error_msg, traceback=traceback.format_exc())
         
         return {
             'statusCode': 500,
-            'body': json.dumps({
-                'content': [
-                    {
-                        'type': 'text',
-                        'text': f'错误: {error_msg}'
-                    }
-                ]
-            })
+            'body': _error_body(error_msg)
         }
+    
+    finally:
+        _current_metrics.reset(metrics_token)
+        stop_profiler(profiler, request_id)
+        metrics.emit(request_id)
+
+def _truncate_text(text: str, max_chars: int) -> str:
+    """截断到 max_chars 个字符以内，尽量在空白处断开"""
+    if len(text) <= max_chars:
+        return text
+    cut = text[:max_chars]
+    space = cut.rfind(' ', max_chars // 2)
+    if space > 0:
+        cut = cut[:space]
+    return cut.rstrip() + ' …'
+
+def _utf8_len(text: str) -> int:
+    # 纯 ASCII 文本（如转义后的响应体）无需编码出副本，isascii 只检查字符串的标志位
+    return len(text) if text.isascii() else len(text.encode('utf-8'))
 
-def format_query_results(result: Dict[str, Any]) -> str:
-    """格式化查询结果为可读文本"""
+def _escaped_len(text: str) -> int:
+    # 文本在响应体中以 ASCII 转义形式出现：中文每个字符占 6 字节，引号、换行占 2 字节
+    return len(_escape_ascii(text))
+
+def _shrink_to_fit(content: str, available: int, measure: Callable[[str], int] = _escaped_len) -> str:
+    """截断内容直到 measure(content) 不超过 available：先按比例估算字符数，再逐步收缩"""
+    content_bytes = measure(content)
+    if content_bytes <= available:
+        return content
+    max_chars = max(1, len(content) * available // content_bytes)
+    content = _truncate_text(content, max_chars)
+    while measure(content) > available and max_chars > 1:
+        max_chars = max_chars * 9 // 10
+        content = _truncate_text(content, max_chars)
+    return content
+
+def format_query_results(result: Dict[str, Any], heading_level: int = 1,
+                         max_bytes: Optional[int] = None, max_chunk_chars: Optional[int] = None) -> str:
+    """格式化查询结果为可读文本，参数同 iter_query_results"""
+    return ''.join(iter_query_results(result, heading_level, max_bytes, max_chunk_chars))
+
+def iter_query_results(result: Dict[str, Any], heading_level: int = 1,
+                       max_bytes: Optional[int] = None, max_chunk_chars: Optional[int] = None) -> Iterator[str]:
+    """
+    逐块格式化查询结果为可读文本：先产出标题部分，之后每条结果一块，heading_level 为顶层标题级别
+    
+    Args:
+        max_bytes: 输出文本转义后的字节预算；按相关度从高到低贪心填充，
+                   放不下的结果先尝试截断内容，仍放不下则省略
+        max_chunk_chars: 单条结果内容的最大字符数，超出部分截断为摘要
+    """
     query = result.get('query', '')
     kb_id = result.get('knowledge_base_id', '')
     results = result.get('results', [])
     count = result.get('count', 0)
     
-    text = f"# 知识库查询结果\n\n"
-    text += f"**查询**: {query}\n"
-    text += f"**知识库ID**: {kb_id}\n"
-    text += f"**结果数量**: {count}\n\n"
+    heading = '#' * heading_level
+    
+    parts = [
+        f"{heading} 知识库查询结果\n\n",
+        f"**查询**: {query}\n",
+        f"**知识库ID**: {kb_id}\n",
+        f"**结果数量**: {count}\n\n"
+    ]
+    
+    for error in result.get('errors', []):
+        parts.append(f"⚠ 知识库 {error['knowledge_base_id']} 查询失败: {error['error']}\n\n")
     
     if not results:
-        text += "未找到相关结果。\n"
-        return text
+        parts.append("未找到相关结果。\n")
+        yield ''.join(parts)
+        return
+    
+    head = ''.join(parts)
+    yield head
     
+    if max_bytes:
+        # 预算模式下按相关度贪心填充
+        results = sorted(results, key=_score_key, reverse=True)
+        # 预留结尾省略提示所需的空间
+        remaining = max_bytes - _escaped_len(head) - OMITTED_NOTE_BYTES
+    
+    omitted = 0
     for idx, item in enumerate(results, 1):
-        content = item.get('content', '无内容')
-        score = item.get('score', 0)
-        location = item.get('location', {})
+        content = item.content
+        location = item.location
+        
+        if max_chunk_chars:
+            content = _truncate_text(content, max_chunk_chars)
         
-        text += f"## 结果 {idx} (相关度: {score:.4f})\n\n"
-        text += f"{content}\n\n"
+        header = f"{heading}# 结果 {idx} (相关度: {item.score:.4f})\n\n"
+        if item.knowledge_base_id is not None:
+            header += f"**知识库**: {item.knowledge_base_id}\n\n"
         
         # 添加来源信息
+        footer = ""
         if location:
             s3_location = location.get('s3Location', {})
             if s3_location:
-                text += f"**来源**: {s3_location.get('uri', '未知')}\n\n"
+                footer += f"**来源**: {s3_location.get('uri', '未知')}\n\n"
+        footer += "---\n\n"
         
-        text += "---\n\n"
+        if max_bytes:
+            overhead = _escaped_len(header) + _escaped_len(footer) + 4
+            content_bytes = _escaped_len(content)
+            if overhead + content_bytes > remaining:
+                # 至少保留 MIN_SNIPPET_BYTES 字节内容才值得输出截断后的摘要
+                available = remaining - overhead
+                if available < MIN_SNIPPET_BYTES:
+                    omitted = len(results) - idx + 1
+                    break
+                content = _shrink_to_fit(content, available)
+            remaining -= overhead + _escaped_len(content)
+        
+        yield f"{header}{content}\n\n{footer}"
     
-    return text
+    if omitted:
+        yield f"*另有 {omitted} 条结果因超出响应大小限制被省略*\n"
+
+def format_batch_results(result: Dict[str, Any], max_bytes: Optional[int] = None,
+                         max_chunk_chars: Optional[int] = None) -> str:
+    """格式化批量查询结果为可读文本，参数同 iter_batch_results"""
+    return ''.join(iter_batch_results(result, max_bytes, max_chunk_chars))
+
+def iter_batch_results(result: Dict[str, Any], max_bytes: Optional[int] = None,
+                       max_chunk_chars: Optional[int] = None) -> Iterator[str]:
+    """逐块格式化批量查询结果为可读文本，max_bytes 扣除标题后在各查询之间平均分配"""
+    items = result.get('items', [])
+    
+    head = (
+        f"# 批量查询结果\n\n"
+        f"**查询数量**: {result.get('count', 0)} (失败: {result.get('failed', 0)})\n\n"
+    )
+    yield head
+    
+    per_query_bytes = None
+    if max_bytes and items:
+        headings_bytes = _escaped_len(head) + len(items) * _escaped_len("## 查询 000\n\n")
+        per_query_bytes = max(1, (max_bytes - headings_bytes) // len(items))
+    
+    for idx, item in enumerate(items, 1):
+        yield f"## 查询 {idx}\n\n"
+        if item['status'] == 'success':
+            yield from iter_query_results(
+                item['result'], heading_level=3,
+                max_bytes=per_query_bytes, max_chunk_chars=max_chunk_chars
+            )
+        else:
+            yield f"**查询**: {item['query']}\n**错误**: {item['error']}\n\n"
+
+def _project_item(item: RetrievalResult, output_format: str, exclude_fields: Tuple[str, ...],
+                  max_chunk_chars: Optional[int]) -> Dict[str, Any]:
+    """按输出格式投影单条查询结果"""
+    if output_format == 'compact':
+        projected = {'content': item.content, 'score': item.score}
+        uri = item.location.get('s3Location', {}).get('uri')
+        if uri:
+            projected['source'] = uri
+        if item.knowledge_base_id is not None:
+            projected['knowledge_base_id'] = item.knowledge_base_id
+    else:
+        projected = item.to_dict()
+    
+    for field in exclude_fields:
+        projected.pop(field, None)
+    if max_chunk_chars and 'content' in projected:
+        projected['content'] = _truncate_text(projected['content'], max_chunk_chars)
+    return projected
+
+def project_query_result(result: Dict[str, Any], output_format: str, exclude_fields: Tuple[str, ...] = (),
+                         max_bytes: Optional[int] = None, max_chunk_chars: Optional[int] = None) -> Dict[str, Any]:
+    """
+    将查询结果投影为结构化输出（json / compact）
+    
+    max_bytes 与 Markdown 模式语义一致：按相关度贪心填充，放不下的结果在剩余预算
+    不少于 MIN_SNIPPET_BYTES 时截断 content，否则省略该结果及之后的结果。
+    """
+    results = result.get('results', [])
+    if max_bytes:
+        results = sorted(results, key=_score_key, reverse=True)
+    
+    projected = {
+        key: result[key]
+        for key in ('query', 'knowledge_base_id', 'knowledge_base_ids', 'errors')
+        if key in result
+    }
+    
+    items = []
+    remaining = (
+        max_bytes - _escaped_len(_JSON_ENCODER.encode(projected)) - OMITTED_NOTE_BYTES if max_bytes else None
+    )
+    for item in results:
+        item = _project_item(item, output_format, exclude_fields, max_chunk_chars)
+        if max_bytes:
+            size = _escaped_len(_JSON_ENCODER.encode(item)) + 2
+            if size > remaining and 'content' in item:
+                overhead = _escaped_len(_JSON_ENCODER.encode(dict(item, content=''))) + 2
+                available = remaining - overhead
+                if available < MIN_SNIPPET_BYTES:
+                    break
+                # 内容先按 JSON 字符串编码、再整体转义进响应体；空字符串的引号已计入 overhead
+                item['content'] = _shrink_to_fit(
+                    item['content'], available, lambda text: _escaped_len(_JSON_ENCODER.encode(text)) - 4
+                )
+                size = overhead + _escaped_len(_JSON_ENCODER.encode(item['content'])) - 4
+            if size > remaining:
+                break
+            remaining -= size
+        items.append(item)
+    
+    projected['results'] = items
+    projected['count'] = len(items)
+    if len(items) < len(results):
+        projected['omitted'] = len(results) - len(items)
+    return projected
+
+def project_batch_result(result: Dict[str, Any], output_format: str, exclude_fields: Tuple[str, ...] = (),
+                         max_bytes: Optional[int] = None, max_chunk_chars: Optional[int] = None) -> Dict[str, Any]:
+    """将批量查询结果投影为结构化输出，max_bytes 在各查询之间平均分配"""
+    items = result.get('items', [])
+    per_query_bytes = max(1, max_bytes // len(items)) if max_bytes and items else None
+    
+    projected_items = []
+    for item in items:
+        if item['status'] == 'success':
+            item = {
+                'status': 'success',
+                'result': project_query_result(
+                    item['result'], output_format, exclude_fields, per_query_bytes, max_chunk_chars
+                )
+            }
+        projected_items.append(item)
+    
+    return dict(result, items=projected_items)
+
+def dump_structured(data: Dict[str, Any], output_format: str) -> str:
+    """序列化结构化输出，compact 模式去掉多余空白"""
+    data = {key: value for key, value in data.items() if key not in REQUEST_META_KEYS}
+    if output_format == 'compact':
+        return _dumps_compact(data)
+    return _JSON_ENCODER.encode(data)
+
+def _dumps_compact(value: Any) -> str:
+    """紧凑 JSON（不转义非 ASCII 字符），有 orjson 时使用 orjson"""
+    if _use_orjson():
+        try:
+            return orjson.dumps(value, default=_json_default).decode('utf-8')
+        except TypeError:  # orjson 不支持的值（如超过 64 位的整数、非字符串键），回退到标准库
+            pass
+    return _COMPACT_JSON_ENCODER.encode(value)
+
+def iter_structured(data: Dict[str, Any], output_format: str) -> Iterator[str]:
+    """
+    逐块序列化结构化输出，拼接结果与 dump_structured 相同
+    
+    顶层的列表字段（如 results / items）按元素分块，其余字段整体序列化。
+    """
+    if output_format == 'compact':
+        item_separator, key_separator = ',', ':'
+        dumps = _dumps_compact
+    else:
+        item_separator, key_separator = ', ', ': '
+        dumps = _JSON_ENCODER.encode
+    
+    fields = [(key, value) for key, value in data.items() if key not in REQUEST_META_KEYS]
+    yield '{'
+    for idx, (key, value) in enumerate(fields):
+        prefix = (item_separator if idx else '') + dumps(key) + key_separator
+        if isinstance(value, list) and value:
+            yield prefix + '[' + dumps(value[0])
+            for element in value[1:]:
+                yield item_separator + dumps(element)
+            yield ']'
+        else:
+            yield prefix + dumps(value)
+    yield '}'
 
 def format_list_results(result: Dict[str, Any]) -> str:
     """格式化知识库列表为可读文本"""
@@ -217,4 +2668,16 @@ def format_list_results(result: Dict[str, Any]) -> str:
         
         text += "\n"
     
+    next_token = result.get('next_token')
+    if next_token:
+        text += f"**还有更多知识库**，使用 next_token 继续获取: `{next_token}`\n"
+    
     return text
+
+# 预置并发的实例在初始化阶段完成预热，第一次真实请求无需再创建 client 或建立连接
+if WARMUP_ON_INIT == 'true' or (
+        WARMUP_ON_INIT == 'auto' and os.environ.get('AWS_LAMBDA_INITIALIZATION_TYPE') == 'provisioned-concurrency'):
+    try:
+        log('INFO', "Warmup on init completed", **warm_up())
+    except Exception as e:
+        log('WARNING', "Warmup on init failed", error=str(e))
@@ -5,7 +5,9 @@ set -e
 
 # Load configuration
 if [ -f .env ]; then
-    export $(cat .env | grep -v '^#' | xargs)
+    set -a
+    . ./.env
+    set +a
 fi
 
 REGION=${AWS_REGION:-us-east-1}
@@ -54,4 +56,16 @@ if [ -n "$KNOWLEDGE_BASE_ID" ]; then
     echo ""
 fi
 
+# Test 4: Warmup event
+echo "[Test 4] Warmup"
+aws lambda invoke \
+  --function-name $FUNCTION_NAME \
+  --payload '{"warmup":true}' \
+  --region $REGION \
+  /tmp/test_warmup.json > /dev/null
+
+echo "Response:"
+cat /tmp/test_warmup.json | python3 -m json.tool
+echo ""
+
 echo "=== Tests Complete ==="
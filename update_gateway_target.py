@@ -39,7 +39,21 @@ def get_tool_spec(tool_name: str):
             "inputSchema": {
                 "json": {
                     "type": "object",
-                    "properties": {},
+                    "properties": {
+                        "max_results": {
+                            "type": "integer",
+                            "description": "Maximum number of knowledge bases to return (optional, returns all if not provided)"
+                        },
+                        "next_token": {
+                            "type": "string",
+                            "description": "Pagination cursor returned by a previous call (optional)"
+                        },
+                        "output_format": {
+                            "type": "string",
+                            "enum": ["markdown", "json", "compact"],
+                            "description": "Response format: readable Markdown (default) or JSON"
+                        }
+                    },
                     "required": []
                 }
             }
@@ -58,17 +72,130 @@ def get_tool_spec(tool_name: str):
                         },
                         "knowledge_base_id": {
                             "type": "string",
-                            "description": "Knowledge Base ID (optional, uses default if not provided)"
+                            "description": "Knowledge Base ID or name (optional, uses default if not provided)"
+                        },
+                        "knowledge_base_ids": {
+                            "type": "array",
+                            "items": {"type": "string"},
+                            "description": "Query several Knowledge Bases in parallel and merge the top results by score (optional)"
+                        },
+                        "use_tagged_kbs": {
+                            "type": "boolean",
+                            "description": "Query all Knowledge Bases tagged for MCP access (optional)"
                         },
                         "number_of_results": {
                             "type": "integer",
                             "description": "Number of results to return (default: 10, max: 100)"
+                        },
+                        "filter": {
+                            "type": "object",
+                            "description": "Bedrock metadata filter applied at the index, e.g. {\"equals\": {\"key\": \"category\", \"value\": \"faq\"}}; combine with andAll/orAll (optional)"
+                        },
+                        "search_type": {
+                            "type": "string",
+                            "enum": ["HYBRID", "SEMANTIC"],
+                            "description": "search type override: HYBRID (vector + keyword) or SEMANTIC (optional, uses the Knowledge Base default if not provided)"
+                        },
+                        "max_response_bytes": {
+                            "type": "integer",
+                            "description": "Maximum size of the response body in bytes, counted as sent (JSON-escaped, non-ASCII characters take 6 bytes each); lower-scored results are truncated or omitted to fit (optional)"
+                        },
+                        "max_chunk_chars": {
+                            "type": "integer",
+                            "description": "Truncate each result's content to this many characters (optional)"
+                        },
+                        "output_format": {
+                            "type": "string",
+                            "enum": ["markdown", "json", "compact"],
+                            "description": "Response format: readable Markdown (default), structured JSON, or compact JSON with only content, score and source"
+                        },
+                        "exclude_fields": {
+                            "type": "array",
+                            "items": {"type": "string"},
+                            "description": "Result fields to drop in json/compact output, e.g. [\"metadata\", \"location\"] (optional)"
                         }
                     },
                     "required": ["query"]
                 }
             }
         }
+    elif tool_name == "BatchQueryKnowledgeBases":
+        return {
+            "name": "BatchQueryKnowledgeBases",
+            "description": "Run several natural language queries against Amazon Bedrock Knowledge Bases in one call. Each query succeeds or fails independently.",
+            "inputSchema": {
+                "json": {
+                    "type": "object",
+                    "properties": {
+                        "queries": {
+                            "type": "array",
+                            "items": {
+                                "type": "object",
+                                "properties": {
+                                    "query": {"type": "string"},
+                                    "knowledge_base_id": {"type": "string"},
+                                    "knowledge_base_ids": {"type": "array", "items": {"type": "string"}},
+                                    "number_of_results": {"type": "integer"},
+                                    "filter": {"type": "object"},
+                                    "search_type": {"type": "string", "enum": ["HYBRID", "SEMANTIC"]}
+                                },
+                                "required": ["query"]
+                            },
+                            "description": "Queries to run; per-query fields override the top-level defaults"
+                        },
+                        "knowledge_base_id": {
+                            "type": "string",
+                            "description": "Default Knowledge Base ID for all queries (optional)"
+                        },
+                        "knowledge_base_ids": {
+                            "type": "array",
+                            "items": {"type": "string"},
+                            "description": "Default list of Knowledge Base IDs for all queries (optional)"
+                        },
+                        "use_tagged_kbs": {
+                            "type": "boolean",
+                            "description": "Query all Knowledge Bases tagged for MCP access (optional)"
+                        },
+                        "number_of_results": {
+                            "type": "integer",
+                            "description": "Default number of results per query (default: 10, max: 100)"
+                        },
+                        "filter": {
+                            "type": "object",
+                            "description": "Default Bedrock metadata filter applied at the index, e.g. {\"equals\": {\"key\": \"category\", \"value\": \"faq\"}}; combine with andAll/orAll (optional)"
+                        },
+                        "search_type": {
+                            "type": "string",
+                            "enum": ["HYBRID", "SEMANTIC"],
+                            "description": "Default search type override: HYBRID (vector + keyword) or SEMANTIC (optional, uses the Knowledge Base default if not provided)"
+                        },
+                        "max_concurrency": {
+                            "type": "integer",
+                            "description": "Maximum number of queries to run concurrently (optional)"
+                        },
+                        "max_response_bytes": {
+                            "type": "integer",
+                            "description": "Maximum size of the whole response body in bytes, counted as sent (JSON-escaped) and shared across queries; lower-scored results are truncated or omitted to fit (optional)"
+                        },
+                        "max_chunk_chars": {
+                            "type": "integer",
+                            "description": "Truncate each result's content to this many characters (optional)"
+                        },
+                        "output_format": {
+                            "type": "string",
+                            "enum": ["markdown", "json", "compact"],
+                            "description": "Response format: readable Markdown (default), structured JSON, or compact JSON with only content, score and source"
+                        },
+                        "exclude_fields": {
+                            "type": "array",
+                            "items": {"type": "string"},
+                            "description": "Result fields to drop in json/compact output, e.g. [\"metadata\", \"location\"] (optional)"
+                        }
+                    },
+                    "required": ["queries"]
+                }
+            }
+        }
     else:
         raise ValueError(f"Unknown tool name: {tool_name}")
 
@@ -25,7 +25,10 @@ fi
 
 # 加载环境变量
 echo -e "${BLUE}[1/4]${NC} 加载配置..."
-export $(cat .env | grep -v '^#' | grep -v '^$' | xargs)
+set -a
+. ./.env
+set +a
+PREVIOUS_LAMBDA_ARN=$LAMBDA_ARN
 
 # 验证必需的环境变量
 if [ -z "$KNOWLEDGE_BASE_ID" ]; then
@@ -48,6 +51,16 @@ fi
 # 设置默认值
 KB_INCLUSION_TAG_KEY=${KB_INCLUSION_TAG_KEY:-mcp-multirag-kb}
 KB_TAG_VALUE=${KB_TAG_VALUE:-true}
+BEDROCK_KB_RERANKING_ENABLED=${BEDROCK_KB_RERANKING_ENABLED:-false}
+
+# Lambda 环境变量（update-function-configuration 会整体替换，可选项为空时不传）
+LAMBDA_ENVIRONMENT="BEDROCK_REGION=$AWS_REGION,KNOWLEDGE_BASE_ID=$KNOWLEDGE_BASE_ID,KB_INCLUSION_TAG_KEY=$KB_INCLUSION_TAG_KEY,KB_TAG_VALUE=$KB_TAG_VALUE,BEDROCK_KB_RERANKING_ENABLED=$BEDROCK_KB_RERANKING_ENABLED"
+if [ -n "$RERANK_SCORER" ]; then
+    LAMBDA_ENVIRONMENT="$LAMBDA_ENVIRONMENT,RERANK_SCORER=$RERANK_SCORER"
+fi
+if [ -n "$RERANK_MODEL_ARN" ]; then
+    LAMBDA_ENVIRONMENT="$LAMBDA_ENVIRONMENT,RERANK_MODEL_ARN=$RERANK_MODEL_ARN"
+fi
 
 echo -e "${GREEN}✓${NC} 配置加载完成"
 echo "  - Lambda Function: $LAMBDA_FUNCTION_NAME"
@@ -67,7 +80,12 @@ echo -e "${GREEN}✓${NC} Lambda 函数存在"
 # 打包代码
 echo -e "${BLUE}[3/4]${NC} 打包代码..."
 rm -f lambda_proxy.zip
+# 增量刷新知识库目录快照（失败不影响部署，Lambda 会回退到实时查询控制面）
+python3 build_kb_catalog.py 2>&1 | grep -E "✓|✗|Added" || true
 zip -q -j lambda_proxy.zip lambda_proxy.py
+if [ -f kb_catalog.json ]; then
+    zip -q -j lambda_proxy.zip kb_catalog.json
+fi
 echo -e "${GREEN}✓${NC} 代码打包完成"
 
 # 更新 Lambda 函数
@@ -91,10 +109,15 @@ aws lambda wait function-updated \
 echo "  - 更新环境变量..."
 aws lambda update-function-configuration \
   --function-name $LAMBDA_FUNCTION_NAME \
-  --environment "Variables={BEDROCK_REGION=$AWS_REGION,KNOWLEDGE_BASE_ID=$KNOWLEDGE_BASE_ID,KB_INCLUSION_TAG_KEY=$KB_INCLUSION_TAG_KEY,KB_TAG_VALUE=$KB_TAG_VALUE}" \
+  --environment "Variables={$LAMBDA_ENVIRONMENT}" \
   --region $AWS_REGION \
   >/dev/null
 
+# 预置并发 / 定时预热（可选）：已有别名时发布新版本并更新别名
+echo "  - 配置预热..."
+WARMING_OUTPUT=$(python3 configure_warming.py 2>&1) || true
+echo "$WARMING_OUTPUT" | grep -E "✓|✗" || true
+
 echo -e "${GREEN}✓${NC} Lambda 函数更新完成"
 echo ""
 
@@ -104,6 +127,24 @@ rm -f lambda_proxy.zip
 # 获取函数信息
 ACCOUNT_ID=$(aws sts get-caller-identity --query Account --output text)
 LAMBDA_ARN="arn:aws:lambda:$AWS_REGION:$ACCOUNT_ID:function:$LAMBDA_FUNCTION_NAME"
+WARMED_LAMBDA_ARN=$(echo "$WARMING_OUTPUT" | grep "^LAMBDA_ARN=" | cut -d= -f2)
+if [ -n "$WARMED_LAMBDA_ARN" ]; then
+    LAMBDA_ARN=$WARMED_LAMBDA_ARN
+fi
+
+# 启用预置并发后 Gateway 需要改为调用别名 ARN：配置了 GATEWAY_ID 时 configure_warming.py 已更新 Target
+if [ -n "$WARMED_LAMBDA_ARN" ] && [ "$LAMBDA_ARN" != "$PREVIOUS_LAMBDA_ARN" ]; then
+    if ! grep -q "^LAMBDA_ARN=" .env 2>/dev/null; then
+        echo "LAMBDA_ARN=$LAMBDA_ARN" >> .env
+    else
+        sed -i.bak "s|^LAMBDA_ARN=.*|LAMBDA_ARN=$LAMBDA_ARN|" .env
+    fi
+    if [ -z "$GATEWAY_ID" ]; then
+        echo -e "${YELLOW}⚠${NC} Lambda ARN 已变为 $LAMBDA_ARN，但 .env 中没有 GATEWAY_ID，Gateway Target 未更新"
+        echo "  请在 .env 中设置 GATEWAY_ID 后重新运行 ./update_lambda.sh，否则预置并发不会生效"
+        echo ""
+    fi
+fi
 
 # 显示摘要
 echo "╔════════════════════════════════════════════════════════════╗"
@@ -120,6 +161,12 @@ echo "  BEDROCK_REGION:        $AWS_REGION"
 echo "  KNOWLEDGE_BASE_ID:     $KNOWLEDGE_BASE_ID"
 echo "  KB_INCLUSION_TAG_KEY:  $KB_INCLUSION_TAG_KEY"
 echo "  KB_TAG_VALUE:          $KB_TAG_VALUE"
+echo "  BEDROCK_KB_RERANKING_ENABLED: $BEDROCK_KB_RERANKING_ENABLED"
+echo "  RERANK_SCORER:         ${RERANK_SCORER:-bm25（默认）}"
+echo ""
+echo -e "${YELLOW}【预热】${NC}"
+echo "  PROVISIONED_CONCURRENCY: ${PROVISIONED_CONCURRENCY:-0}"
+echo "  WARMER_SCHEDULE:         ${WARMER_SCHEDULE:-未启用}"
 echo ""
 echo -e "${YELLOW}【测试命令】${NC}"
 echo "  ./test_lambda.sh"